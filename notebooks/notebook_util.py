@@ -36,8 +36,8 @@ def print_eval_row(errors, scores):
     return row.round(3)[col_order]
     #return row
     
-def calculate_errors(out, sample, tokenizer):
+def calculate_errors(out, sample, tokenizer, cache=None):
     gen_text = [o if type(o) == str else o['generated_text'] for o in out]
-    errors = error_analysis(gen_text, encode_decode(sample.full_resolution, tokenizer), encode_decode(sample.raw_sentence, tokenizer))
+    errors = error_analysis(gen_text, encode_decode(sample.full_resolution, tokenizer, cache), encode_decode(sample.raw_sentence, tokenizer, cache))
     errors = pd.concat([errors, sample[['file', 'sentence_id']].reset_index()], axis=1)
     return errors
\ No newline at end of file
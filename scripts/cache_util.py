@@ -0,0 +1,161 @@
+import hashlib
+import json
+import sqlite3
+import weakref
+from pathlib import Path
+
+import torch
+
+def hash_key(*parts):
+    h = hashlib.sha256()
+    for p in parts:
+        h.update(json.dumps(p, ensure_ascii=False, sort_keys=True, default=str).encode('utf-8'))
+        h.update(b'\x00')
+    return h.hexdigest()
+
+def tokenizer_fingerprint(tokenizer):
+    # Tokenizers loaded from the same files produce the same ids, so name, class and vocabulary identify them.
+    # The decoded text also depends on the decoding settings and, for fast tokenizers, on the normalizer,
+    # pre-tokenizer and decoder pipeline (e.g. the sentencepiece legacy mode)
+    vocab = tokenizer.get_vocab()
+    return hash_key(
+        type(tokenizer).__name__,
+        tokenizer.name_or_path,
+        len(vocab),
+        hash_key(sorted(vocab.items())),
+        tokenizer.all_special_tokens,
+        tokenizer.clean_up_tokenization_spaces,
+        getattr(tokenizer, 'legacy', tokenizer.init_kwargs.get('legacy')),
+        hash_key(tokenizer.backend_tokenizer.to_str()) if tokenizer.is_fast else None,
+    )
+
+def _update_hash(h, value):
+    if isinstance(value, (tuple, list)):
+        # Dynamically quantized linear layers store (weight, bias) tuples
+        for v in value:
+            _update_hash(h, v)
+    elif hasattr(value, 'detach'):
+        value = value.detach().cpu()
+        h.update(str(value.dtype).encode('utf-8'))
+        h.update(str(tuple(value.shape)).encode('utf-8'))
+        if value.is_quantized:
+            if value.qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric):
+                _update_hash(h, (value.q_per_channel_scales(), value.q_per_channel_zero_points()))
+            else:
+                h.update(repr((value.q_scale(), value.q_zero_point())).encode('utf-8'))
+            value = value.int_repr()
+        h.update(value.contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    else:
+        h.update(repr(value).encode('utf-8'))
+
+def model_fingerprint(model):
+    h = hashlib.blake2b(digest_size=32)
+    for name, value in sorted(model.state_dict().items(), key=lambda kv: kv[0]):
+        h.update(name.encode('utf-8'))
+        _update_hash(h, value)
+    return h.hexdigest()
+
+# Persistent key-value store backed by a local SQLite file, values are stored as JSON
+class DiskCache:
+
+    def __init__(self, path, table='cache'):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.table = table
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS {self.table} (key TEXT PRIMARY KEY, value TEXT)')
+        self.connection.commit()
+
+    def get(self, key, default=None):
+        row = self.connection.execute(f'SELECT value FROM {self.table} WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def get_many(self, keys, chunk_size=500):
+        keys = list(dict.fromkeys(keys))
+        res = {}
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connection.execute(f'SELECT key, value FROM {self.table} WHERE key IN ({placeholders})', chunk)
+            res.update({k: json.loads(v) for k, v in rows})
+        return res
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        self.connection.executemany(
+            f'INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)',
+            [(k, json.dumps(v, ensure_ascii=False)) for k, v in items.items()])
+        self.connection.commit()
+
+    def __contains__(self, key):
+        return self.connection.execute(f'SELECT 1 FROM {self.table} WHERE key = ?', (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self.connection.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+# Caches the tokenizer round trip (encode + decode) of reference and source sentences
+class NormalisationCache:
+
+    def __init__(self, path):
+        self.store = DiskCache(path, table='normalisation')
+        # Weak keys, a new tokenizer cannot reuse the fingerprint of a garbage-collected one
+        self._fingerprints = weakref.WeakKeyDictionary()
+
+    def _fingerprint(self, tokenizer):
+        if tokenizer not in self._fingerprints:
+            self._fingerprints[tokenizer] = tokenizer_fingerprint(tokenizer)
+        return self._fingerprints[tokenizer]
+
+    def encode_decode(self, sentences, tokenizer):
+        sentences = list(sentences)
+        fingerprint = self._fingerprint(tokenizer)
+        keys = [hash_key(fingerprint, s) for s in sentences]
+        found = self.store.get_many(keys)
+
+        missing = list(dict.fromkeys(s for s, k in zip(sentences, keys) if k not in found))
+        if missing:
+            decoded = tokenizer.batch_decode(tokenizer(missing)['input_ids'], skip_special_tokens=True)
+            new_entries = {hash_key(fingerprint, s): d for s, d in zip(missing, decoded)}
+            self.store.set_many(new_entries)
+            found.update(new_entries)
+
+        return [found[k] for k in keys]
+
+# Caches generated outputs per (model weights, tokenizer, sentence, decoding parameters)
+class GenerationCache:
+
+    def __init__(self, path):
+        self.store = DiskCache(path, table='generation')
+
+    @staticmethod
+    def key(model_fp, tokenizer_fp, sentence, max_length, generate_kwargs):
+        params = {'num_beams' : 1, 'num_return_sequences' : 1}
+        params.update(generate_kwargs)
+        return hash_key(model_fp, tokenizer_fp, sentence, max_length, params)
+
+    def get_many(self, keys):
+        return self.store.get_many(keys)
+
+    def set_many(self, items):
+        self.store.set_many(items)
+
+# Caches LLM responses per (backend model, prompt, request parameters)
+class LLMCache:
+
+    def __init__(self, path):
+        self.store = DiskCache(path, table='llm')
+
+    @staticmethod
+    def key(model, prompt, params):
+        return hash_key(model, prompt, params)
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value):
+        self.store.set(key, value)
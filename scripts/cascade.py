@@ -0,0 +1,113 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+from llm_client import LLMClient
+
+def beam_margins(outputs):
+    # outputs: per sentence the ranked [text, score] candidates of BatchedGenerator(return_scores=True),
+    # the margin is the score difference between the first and the second beam (inf with a single candidate)
+    return np.array([c[0][1] - c[1][1] if len(c) > 1 else np.inf for c in outputs], dtype=float)
+
+def threshold_curve(margins, top1_correct, reranked_correct):
+    # Accuracy and escalation rate when every sentence with margin < threshold is sent to the reranker,
+    # for all thresholds that change the decision on the calibration set
+    margins = np.asarray(margins, dtype=float)
+    top1_correct = np.asarray(top1_correct, dtype=float)
+    reranked_correct = np.asarray(reranked_correct, dtype=float)
+
+    # Sentences with a single candidate (inf margin) are never escalated (margin < threshold), the reranker could not change them
+    escalable = np.flatnonzero(margins < np.inf)
+    order = escalable[np.argsort(margins[escalable], kind='stable')]
+    gain = (reranked_correct - top1_correct)[order]
+    thresholds = np.concatenate([[-np.inf], np.nextafter(margins[order], np.inf)])
+    n_escalated = np.arange(len(order) + 1)
+    accuracy = (top1_correct.sum() + np.concatenate([[0], np.cumsum(gain)])) / len(margins)
+
+    curve = pd.DataFrame({'threshold' : thresholds, 'n_escalated' : n_escalated, 'escalation_rate' : n_escalated / len(margins), 'accuracy' : accuracy})
+    # Tied margins are escalated together
+    return curve.drop_duplicates('threshold', keep='last').reset_index(drop=True)
+
+def calibrate_threshold(curve, cost_per_escalation=0.0, max_escalation_rate=1.0):
+    # Maximises accuracy - cost_per_escalation * escalation_rate within the escalation budget,
+    # ties go to the lower escalation rate
+    feasible = curve[curve.escalation_rate <= max_escalation_rate]
+    utility = feasible.accuracy - cost_per_escalation * feasible.escalation_rate
+    return float(feasible.threshold.loc[utility.idxmax()])
+
+def parse_choice(answer, n_candidates):
+    # 1-based option number in the reranker answer -> candidate index, None if missing or out of range
+    numbers = re.findall(r'\d+', answer or '')
+    if not numbers or not 1 <= int(numbers[0]) <= n_candidates:
+        return None
+    return int(numbers[0]) - 1
+
+# Multiple-choice reranking of the candidate list by an LLM (see llm_client.py), falls back to the top beam
+class LLMReranker:
+
+    def __init__(self, client, prompt_fn):
+        self.client = client
+        self.prompt_fn = prompt_fn
+        self.n_parse_errors = 0
+
+    def __call__(self, sentences, candidates):
+        prompts = [LLMClient.messages([('user', self.prompt_fn(s, c))]) for s, c in zip(sentences, candidates)]
+        res = []
+        for c, response in zip(candidates, self.client.complete_many(prompts)):
+            index = parse_choice(response['text'], len(c))
+            if index is None:
+                self.n_parse_errors += 1
+                index = 0
+            res.append(c[index])
+        return res
+
+# Accepts the top beam when the model is confident (margin >= threshold), only low-margin sentences go to the reranker
+class CascadeResolver:
+
+    def __init__(self, generator, reranker, threshold):
+        self.generator = generator
+        self.reranker = reranker
+        self.threshold = threshold
+        self.reset_stats()
+
+    @classmethod
+    def from_curve(cls, generator, reranker, curve, config):
+        cascade_config = config.get('cascade', {})
+        threshold = calibrate_threshold(curve,
+            cost_per_escalation=cascade_config.get('cost_per_escalation', 0.0),
+            max_escalation_rate=cascade_config.get('max_escalation_rate', 1.0))
+        return cls(generator, reranker, threshold)
+
+    def reset_stats(self):
+        self.n_sentences = 0
+        self.n_escalated = 0
+        self.margins = []
+
+    def report(self, key='cascade'):
+        margins = np.array(self.margins)
+        finite = margins[np.isfinite(margins)]
+        return {
+            f'{key}/threshold' : self.threshold,
+            f'{key}/n_sentences' : self.n_sentences,
+            f'{key}/n_escalated' : self.n_escalated,
+            f'{key}/escalation_rate' : self.n_escalated / self.n_sentences if self.n_sentences else 0.0,
+            f'{key}/margin_p50' : float(np.median(finite)) if len(finite) else None,
+        }
+
+    def __call__(self, sentences):
+        sentences = list(sentences)
+        outputs = self.generator(sentences)
+        margins = beam_margins(outputs)
+        escalate = np.flatnonzero(margins < self.threshold)
+
+        res = [c[0][0] for c in outputs]
+        if len(escalate):
+            reranked = self.reranker([sentences[i] for i in escalate], [[t for t, _ in outputs[i]] for i in escalate])
+            for i, r in zip(escalate, reranked):
+                res[i] = r
+
+        self.n_sentences += len(sentences)
+        self.n_escalated += len(escalate)
+        self.margins.extend(margins.tolist())
+        return res
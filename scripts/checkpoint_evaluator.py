@@ -0,0 +1,148 @@
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import traceback
+
+import pandas as pd
+import torch
+from omegaconf import OmegaConf
+from transformers import AutoModelForSeq2SeqLM, TrainerCallback
+
+from cache_util import NormalisationCache
+from evaluation import error_analysis, get_scores, encode_decode
+from inference import BatchedGenerator
+from span_resolution import SpanResolver
+from transformers_util import get_tokenizer
+
+log = logging.getLogger(__name__)
+
+def evaluate_checkpoint(path, config, sample, tokenizer, device, norm_cache=None):
+    # Same decoding as the post-training analysis in run_experiment, without generation cache and memory
+    model = AutoModelForSeq2SeqLM.from_pretrained(path)
+    generator = BatchedGenerator.from_config(model, tokenizer, config, device=device)
+    resolver = SpanResolver.from_config(generator, config) if config.inference.get('mode') == 'span' else generator
+    gen = resolver(sample.raw_sentence)
+    if resolver is not generator:
+        gen = encode_decode(gen, tokenizer)
+    errors = error_analysis(gen, encode_decode(sample.full_resolution, tokenizer, norm_cache), encode_decode(sample.raw_sentence, tokenizer, norm_cache))
+    errors = pd.concat([errors, sample[['file', 'sentence_id']].reset_index(drop=True)], axis=1)
+    return errors, generator.stats.report('eval/inference')
+
+def _worker(config, sample, norm_cache_path, jobs, results):
+    config = OmegaConf.create(config)
+    eval_config = config.checkpoint_eval
+    if eval_config.get('num_threads'):
+        torch.set_num_threads(eval_config.num_threads)
+    tokenizer = get_tokenizer(config)
+    norm_cache = NormalisationCache(norm_cache_path) if norm_cache_path else None
+    while (job := jobs.get()) is not None:
+        path, step = job
+        try:
+            errors, inference_stats = evaluate_checkpoint(path, config, sample, tokenizer, eval_config.get('device', 'auto'), norm_cache)
+            results.put((path, step, get_scores(errors, 'eval') | inference_stats, errors, None))
+        except Exception:
+            # E.g. the checkpoint was deleted before it was loaded
+            results.put((path, step, None, None, traceback.format_exc()))
+
+# Evaluates the saved checkpoints with full generation in a separate process while training continues
+class CheckpointEvaluator:
+
+    def __init__(self, config, sample, metric='eval/exact_match', keep_best_only=True, norm_cache_path=None):
+        self.metric = metric
+        self.keep_best_only = keep_best_only
+        self.results = {}
+        self.best = None
+        self.n_pending = 0
+        self.submitted = set()
+
+        ctx = multiprocessing.get_context('spawn')
+        self.jobs = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.process = ctx.Process(
+            target=_worker,
+            args=(OmegaConf.to_container(config, resolve=True), sample, norm_cache_path, self.jobs, self.result_queue),
+            daemon=True)
+        self.process.start()
+
+    def submit(self, path, step):
+        # The last checkpoint can be saved twice (end of epoch and end of training)
+        if step in self.submitted:
+            return
+        self.submitted.add(step)
+        self.n_pending += 1
+        self.jobs.put((os.path.abspath(path), step))
+
+    def _record(self, path, step, scores, errors, error):
+        self.n_pending -= 1
+        if error:
+            log.warning(f'Evaluation of {path} failed:\n{error}')
+            return None
+        self.results[path] = (step, scores, errors)
+        if self.best is None or scores[self.metric] > self.results[self.best][1][self.metric]:
+            previous, self.best = self.best, path
+            if previous and self.keep_best_only:
+                shutil.rmtree(previous, ignore_errors=True)
+        elif self.keep_best_only:
+            shutil.rmtree(path, ignore_errors=True)
+        return path
+
+    def poll(self):
+        # Paths of the checkpoints evaluated since the last call, does not block
+        res = []
+        while self.n_pending:
+            try:
+                result = self.result_queue.get_nowait()
+            except queue.Empty:
+                break
+            path = self._record(*result)
+            if path:
+                res.append(path)
+        return res
+
+    def close(self):
+        # Waits for the pending checkpoints
+        self.jobs.put(None)
+        res = []
+        while self.n_pending:
+            path = self._record(*self.result_queue.get())
+            if path:
+                res.append(path)
+        self.process.join()
+        return res
+
+    def scores(self, path):
+        return self.results[path][1]
+
+    def errors(self, path):
+        return self.results[path][2]
+
+# Hands every saved checkpoint to the evaluator and feeds its results back into the trainer: logged as eval
+# metrics, passed to the on_evaluate callbacks (pruning) and used for the best checkpoint
+class BackgroundEvaluationCallback(TrainerCallback):
+
+    def __init__(self, evaluator):
+        self.evaluator = evaluator
+        self.trainer = None
+
+    def _report(self, paths, args, state, control):
+        for path in paths:
+            step, scores, _ = self.evaluator.results[path]
+            metrics = {k.replace('/', '_') : v for k, v in scores.items() if isinstance(v, (int, float))}
+            metrics['eval_checkpoint_step'] = step
+            self.trainer.log(metrics)
+            control = self.trainer.callback_handler.on_evaluate(args, state, control, metrics=metrics)
+        if self.evaluator.best:
+            state.best_model_checkpoint = self.evaluator.best
+            state.best_metric = self.evaluator.scores(self.evaluator.best)[self.evaluator.metric]
+        return control
+
+    def on_save(self, args, state, control, **kwargs):
+        self.evaluator.submit(os.path.join(args.output_dir, f'checkpoint-{state.global_step}'), state.global_step)
+
+    def on_step_end(self, args, state, control, **kwargs):
+        return self._report(self.evaluator.poll(), args, state, control)
+
+    def on_train_end(self, args, state, control, **kwargs):
+        return self._report(self.evaluator.close(), args, state, control)
@@ -0,0 +1,116 @@
+import numpy as np
+import torch.nn.functional as F
+from torch.utils.data import Dataset, Sampler
+
+class IndexedDataset(Dataset):
+    # Adds the position of every example, so that the trainer can report per-example losses to the sampler
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        return dict(self.dataset[index], example_index=index)
+
+    def __len__(self):
+        return len(self.dataset)
+
+def per_example_loss(logits, labels):
+    # Mean token cross-entropy of every sequence
+    token_loss = F.cross_entropy(logits.transpose(1, 2).float(), labels, ignore_index=-100, reduction='none')
+    mask = labels != -100
+    return (token_loss * mask).sum(-1) / mask.sum(-1).clamp(min=1)
+
+# Every epoch contains all ellipses and a subset of the control sentences (identity pairs): controls whose last
+# training loss is above hard_loss_threshold are always kept, the others are sampled with probability proportional
+# to their loss until min_control_fraction of the controls is reached. Controls without a loss yet are always kept.
+# The losses of dropped controls are not updated, so exploration_fraction of the controls, those that were used
+# the longest time ago, are added every epoch to detect forgotten controls
+class AdaptiveControlSampler(Sampler):
+
+    def __init__(self, is_control, min_control_fraction=0.2, hard_loss_threshold=0.05, exploration_fraction=0.05, seed=42):
+        self.is_control = np.asarray(is_control, dtype=bool)
+        self.min_control_fraction = min_control_fraction
+        self.hard_loss_threshold = hard_loss_threshold
+        self.exploration_fraction = exploration_fraction
+        self.seed = seed
+        self.losses = np.full(len(self.is_control), np.inf)
+        self.last_used = np.full(len(self.is_control), -1)
+        self.epoch = 0
+        self.history = []
+        self._indices = None
+
+    @classmethod
+    def from_config(cls, is_control, config, **kwargs):
+        sampling_config = config.get('control_sampling', {})
+        params = dict(
+            min_control_fraction=sampling_config.get('min_control_fraction', 0.2),
+            hard_loss_threshold=sampling_config.get('hard_loss_threshold', 0.05),
+            exploration_fraction=sampling_config.get('exploration_fraction', 0.05),
+            seed=config.random_seed,
+        )
+        params.update(kwargs)
+        return cls(is_control, **params)
+
+    def update(self, indices, losses):
+        self.losses[np.asarray(indices)] = np.asarray(losses)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _select(self):
+        if self._indices is not None:
+            return self._indices
+        rng = np.random.default_rng(self.seed + len(self.history))
+        controls = np.flatnonzero(self.is_control)
+        losses = self.losses[controls]
+
+        keep = losses > self.hard_loss_threshold
+        n_hard = int(keep.sum())
+
+        candidates = np.flatnonzero(~keep)
+        n_explore = min(int(np.ceil(self.exploration_fraction * len(controls))), len(candidates))
+        if n_explore:
+            # Least recently used first, ties in random order
+            keep[candidates[np.lexsort((rng.random(len(candidates)), self.last_used[controls[candidates]]))[:n_explore]]] = True
+
+        n_min = int(np.ceil(self.min_control_fraction * len(controls)))
+        if keep.sum() < n_min:
+            candidates = np.flatnonzero(~keep)
+            weights = losses[candidates] + 1e-6
+            keep[rng.choice(candidates, n_min - keep.sum(), replace=False, p=weights / weights.sum())] = True
+
+        self.last_used[controls[keep]] = len(self.history)
+        self._indices = np.concatenate([np.flatnonzero(~self.is_control), controls[keep]])
+        self.history.append({'n_controls' : int(keep.sum()), 'n_hard_controls' : n_hard, 'n_explored_controls' : n_explore, 'n_examples' : len(self._indices)})
+        return self._indices
+
+    def n_examples(self, epoch):
+        # Training examples in the first (fractional) epochs
+        sizes = [h['n_examples'] for h in self.history]
+        full = int(epoch)
+        return sum(sizes[:full]) + ((epoch - full) * sizes[full] if full < len(sizes) else 0)
+
+    def __len__(self):
+        return len(self._select())
+
+    def __iter__(self):
+        indices = self._select()
+        # The next epoch selects again, with the losses of this epoch
+        self._indices = None
+        rng = np.random.default_rng(self.seed + 1000 + len(self.history))
+        return iter(rng.permutation(indices).tolist())
+
+    def report(self, key='control_sampling'):
+        n_controls = int(self.is_control.sum())
+        epochs = self.history[:-1] if self._indices is not None else self.history
+        if not epochs:
+            return {}
+        full_epoch = len(self.is_control)
+        return {
+            f'{key}/n_controls' : n_controls,
+            f'{key}/mean_controls_per_epoch' : float(np.mean([h['n_controls'] for h in epochs])),
+            f'{key}/last_epoch_controls' : epochs[-1]['n_controls'],
+            f'{key}/last_epoch_hard_controls' : epochs[-1]['n_hard_controls'],
+            # Training examples saved compared to using every control in every epoch
+            f'{key}/example_reduction' : 1 - sum(h['n_examples'] for h in epochs) / (full_epoch * len(epochs)),
+        }
@@ -1,6 +1,9 @@
 import pandas as pd
+from pathlib import Path
 from torch.utils.data import Dataset
 
+from edit_tagging import split_words, derive_tags
+
 class EllipsesDataset(Dataset):
 
     def __init__(self, sentences, references, tokenizer):
@@ -25,6 +28,32 @@ class EllipsesDataset(Dataset):
     def __len__(self):
         return self.n_samples
 
+class EditTaggingDataset(Dataset):
+
+    def __init__(self, sentences, references, tokenizer, vocab):
+        words = [[w for _, _, w in split_words(s)] for s in sentences]
+        tags = [vocab.encode(derive_tags(s, r)) for s, r in zip(sentences, references)]
+        self.encodings = tokenizer(words, is_split_into_words=True, truncation=True)
+
+        self.labels = []
+        for i, word_tags in enumerate(tags):
+            # Only the first sub-token of each word carries a label
+            labels, previous = [], None
+            for word_id in self.encodings.word_ids(i):
+                labels.append(-100 if word_id is None or word_id == previous else word_tags[word_id])
+                previous = word_id
+            self.labels.append(labels)
+
+    def __getitem__(self, index):
+        return dict(
+            input_ids=self.encodings['input_ids'][index],
+            attention_mask=self.encodings['attention_mask'][index],
+            labels=self.labels[index]
+        )
+
+    def __len__(self):
+        return len(self.labels)
+
 def load_data(cnf_tsv, control_tsv=None, sample_frac = None):
     dataset = pd.read_csv(cnf_tsv, sep='\t')
     dataset['controls'] = False
@@ -49,4 +78,29 @@ def get_dataloader(train_df, val_df, test_df, tokenizer):
     train_data = EllipsesDataset(train_df.raw_sentence, train_df.full_resolution, tokenizer)
     val_data = EllipsesDataset(val_df.raw_sentence, val_df.full_resolution, tokenizer)
     test_data = EllipsesDataset(test_df.raw_sentence, test_df.full_resolution, tokenizer)
-    return train_data, val_data, test_data
\ No newline at end of file
+    return train_data, val_data, test_data
+
+def get_tagging_dataloader(train_df, val_df, test_df, tokenizer, vocab):
+    train_data = EditTaggingDataset(train_df.raw_sentence, train_df.full_resolution, tokenizer, vocab)
+    val_data = EditTaggingDataset(val_df.raw_sentence, val_df.full_resolution, tokenizer, vocab)
+    test_data = EditTaggingDataset(test_df.raw_sentence, test_df.full_resolution, tokenizer, vocab)
+    return train_data, val_data, test_data
+
+def read_corpus_sentences(path, tokens=False):
+    # Yields (file, sentence_id, sentence) for every file of a GGPONC plain text directory: one sentence per line,
+    # or with tokens=True one token per line and empty lines between sentences (tokens are joined with spaces)
+    for file in sorted(p for p in Path(path).iterdir() if p.is_file()):
+        with open(file, encoding='utf-8') as f:
+            lines = [line.rstrip('\n') for line in f]
+        if tokens:
+            sentences, current = [], []
+            for line in lines + ['']:
+                if line.strip():
+                    current.append(line.strip())
+                elif current:
+                    sentences.append(' '.join(current))
+                    current = []
+        else:
+            sentences = [line.strip() for line in lines if line.strip()]
+        for i, sentence in enumerate(sentences):
+            yield file.name, i, sentence
@@ -0,0 +1,29 @@
+import numpy as np
+import pandas as pd
+import torch.nn.functional as F
+
+def distillation_loss(student_logits, teacher_logits, labels, temperature=2.0):
+    # Token-level KL(teacher || student) of the temperature-softened distributions on the target positions,
+    # scaled by T^2 to keep the gradient magnitude independent of the temperature
+    if student_logits.shape[-1] != teacher_logits.shape[-1]:
+        raise ValueError(f'Student and teacher vocabularies differ ({student_logits.shape[-1]} vs. {teacher_logits.shape[-1]})')
+    mask = labels != -100
+    student = F.log_softmax(student_logits[mask] / temperature, dim=-1)
+    teacher = F.log_softmax(teacher_logits[mask] / temperature, dim=-1)
+    return F.kl_div(student, teacher, log_target=True, reduction='batchmean') * temperature ** 2
+
+def get_distillation_data(train_df, corpus_sentences, teacher, use_gold=True, seed=42, max_corpus_sentences=None, exclude=()):
+    # Training pairs for the student: the annotated training split (gold or teacher targets) and unlabelled corpus
+    # sentences with the teacher outputs as targets. Sentences in exclude (dev/test) are not used
+    corpus = pd.DataFrame(corpus_sentences, columns=['file', 'sentence_id', 'raw_sentence'])
+    corpus = corpus[~corpus.raw_sentence.isin(set(exclude)) & ~corpus.raw_sentence.isin(set(train_df.raw_sentence))]
+    corpus = corpus.drop_duplicates('raw_sentence')
+    if max_corpus_sentences and len(corpus) > max_corpus_sentences:
+        corpus = corpus.iloc[np.sort(np.random.default_rng(seed).choice(len(corpus), max_corpus_sentences, replace=False))]
+
+    labelled = train_df[['file', 'sentence_id', 'raw_sentence', 'full_resolution']].copy()
+    labelled['source'] = 'train'
+    if not use_gold:
+        labelled['full_resolution'] = teacher(labelled.raw_sentence)
+    corpus = corpus.assign(full_resolution=teacher(corpus.raw_sentence), source='corpus')
+    return pd.concat([labelled, corpus], ignore_index=True)
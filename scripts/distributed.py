@@ -0,0 +1,96 @@
+import logging
+import math
+import multiprocessing
+import os
+import socket
+import time
+
+import torch
+import torch.distributed as dist
+from hydra.core.hydra_config import HydraConfig
+from hydra.core.utils import setup_globals, configure_log
+from transformers import TrainerCallback
+
+log = logging.getLogger(__name__)
+
+def world_size():
+    return int(os.environ.get('WORLD_SIZE', 1))
+
+def is_main_process():
+    return int(os.environ.get('RANK', 0)) == 0
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _worker(rank, num_processes, port, threads, hydra_config, result_queue, fn, args):
+    # The Trainer (accelerate) picks up the process group from the environment
+    os.environ.update(RANK=str(rank), LOCAL_RANK=str(rank), WORLD_SIZE=str(num_processes),
+        LOCAL_WORLD_SIZE=str(num_processes), MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), OMP_NUM_THREADS=str(threads))
+    torch.set_num_threads(threads)
+    # HydraConfig, to_absolute_path etc. as in the launching job
+    if hydra_config is not None:
+        setup_globals()
+        HydraConfig.instance().set_config(hydra_config)
+        if rank == 0:
+            configure_log(hydra_config.hydra.job_logging, hydra_config.hydra.verbose)
+    res = fn(*args)
+    if rank == 0:
+        result_queue.put(res)
+
+def launch(fn, num_processes, *args, threads_per_process=None):
+    # Runs fn(*args) in num_processes local processes (one DDP rank each) and returns the result of rank 0
+    threads = threads_per_process or max(1, (os.cpu_count() or 1) // num_processes)
+    log.info(f'Launching {num_processes} processes with {threads} threads each')
+    ctx = multiprocessing.get_context('spawn')
+    result_queue = ctx.SimpleQueue()
+    port = _free_port()
+    # Full config of the job including the hydra node, which can interpolate the job config
+    hydra_config = HydraConfig.get()._get_parent() if HydraConfig.initialized() else None
+    processes = [
+        ctx.Process(target=_worker, args=(rank, num_processes, port, threads, hydra_config, result_queue, fn, args))
+        for rank in range(num_processes)
+    ]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    failed = [rank for rank, p in enumerate(processes) if p.exitcode != 0]
+    if failed:
+        raise RuntimeError(f'Ranks {failed} failed')
+    return result_queue.get()
+
+# Training throughput of every rank, measured over the training steps only (without evaluation and checkpointing).
+# With an AdaptiveControlSampler (control_sampling.py), the sizes of the sampled epochs are used
+class ThroughputCallback(TrainerCallback):
+
+    def __init__(self, n_train_samples, sampler=None):
+        self.n_train_samples = n_train_samples
+        self.sampler = sampler
+        self.train_seconds = 0.0
+        self.step_start = None
+        self.report = None
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self.step_start = time.perf_counter()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.train_seconds += time.perf_counter() - self.step_start
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.sampler is not None:
+            samples = self.sampler.n_examples(state.epoch)
+        else:
+            # The distributed sampler pads every shard to the same size
+            samples = math.ceil(self.n_train_samples / args.world_size) * state.epoch
+        rates = [samples / self.train_seconds if self.train_seconds else 0.0]
+        if dist.is_available() and dist.is_initialized():
+            rates = [None] * dist.get_world_size()
+            dist.all_gather_object(rates, samples / self.train_seconds if self.train_seconds else 0.0)
+        self.report = {f'throughput/rank_{rank}_samples_per_s' : r for rank, r in enumerate(rates)} | {
+            'throughput/world_size' : len(rates),
+            'throughput/threads_per_process' : torch.get_num_threads(),
+            'throughput/samples_per_s_per_process' : sum(rates) / len(rates),
+            'throughput/samples_per_s' : sum(rates),
+        }
@@ -0,0 +1,186 @@
+import difflib
+import json
+import re
+from collections import Counter
+
+import numpy as np
+import torch
+
+from inference import get_device
+
+# Word-level edit tags: resolutions are (almost) pure insertions relative to the input, so every
+# input word gets one tag that rewrites it in place
+#   KEEP            word unchanged
+#   DELETE          word removed
+#   R|<n>|<suffix>  remove n characters at the end and append suffix (Chemo- -> Chemotherapie: R|1|therapie)
+#   L|<n>|<prefix>  remove n characters at the start and prepend prefix (–ausdehnung -> Tumorausdehnung: L|1|Tumor)
+# R and L keep trailing punctuation in place (Erkrankungs-, -> Erkrankungsrisiko,: R|1|risiko), RW and LW edit the whole word
+KEEP = 'KEEP'
+DELETE = 'DELETE'
+TRAILING_PUNCTUATION = re.compile(r'[,;:.)\]]*$')
+
+def split_words(sentence):
+    return [(m.start(), m.end(), m.group()) for m in re.finditer(r'\S+', sentence)]
+
+def _common_prefix(a, b):
+    n = 0
+    while n < min(len(a), len(b)) and a[n] == b[n]:
+        n += 1
+    return n
+
+def _split_punctuation(word):
+    m = TRAILING_PUNCTUATION.search(word)
+    return word[:m.start()], word[m.start():]
+
+def derive_tag(word, target):
+    if word == target:
+        return KEEP
+    if target == '':
+        return DELETE
+    (word_core, word_punct), (target_core, target_punct) = _split_punctuation(word), _split_punctuation(target)
+    if word_punct == target_punct and word_core and target_core:
+        word, target, whole = word_core, target_core, ''
+    else:
+        whole = 'W'
+    p = _common_prefix(word, target)
+    s = min(_common_prefix(word[::-1], target[::-1]), min(len(word), len(target)) - p)
+    right = f'R{whole}|{len(word) - p}|{target[p:]}'
+    left = f'L{whole}|{len(word) - s}|{target[:len(target) - s]}'
+    # Prefer the edit with the shorter insertion, ties go to suffixes (the more frequent case)
+    return right if len(target) - p <= len(target) - s else left
+
+def apply_tag(word, tag):
+    if tag == KEEP:
+        return word
+    if tag == DELETE:
+        return ''
+    side, n, insertion = tag.split('|', 2)
+    n = int(n)
+    core, punct = _split_punctuation(word)
+    if side.endswith('W') or not core:
+        core, punct = word, ''
+    if side.startswith('R'):
+        return core[:max(len(core) - n, 0)] + insertion + punct
+    return insertion + core[n:] + punct
+
+def word_targets(raw_sentence, resolution):
+    # Aligns input and output words with difflib opcodes and attributes every output word to an input word
+    words = [w for _, _, w in split_words(raw_sentence)]
+    target_words = [w for _, _, w in split_words(resolution)]
+    targets = list(words)
+    matcher = difflib.SequenceMatcher(None, words, target_words, autojunk=False)
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op == 'equal':
+            continue
+        if op == 'delete':
+            for i in range(i1, i2):
+                targets[i] = ''
+        elif op == 'insert':
+            if i1 > 0:
+                targets[i1 - 1] = ' '.join([targets[i1 - 1]] + target_words[j1:j2])
+            else:
+                targets[0] = ' '.join(target_words[j1:j2] + [targets[0]])
+        else:
+            # Pairwise for the first words, the last input word takes the remaining output words
+            n = i2 - i1
+            for k in range(n - 1):
+                targets[i1 + k] = target_words[j1 + k] if j1 + k < j2 else ''
+            targets[i2 - 1] = ' '.join(target_words[j1 + n - 1:j2])
+    return targets
+
+def derive_tags(raw_sentence, resolution):
+    words = [w for _, _, w in split_words(raw_sentence)]
+    return [derive_tag(w, t) for w, t in zip(words, word_targets(raw_sentence, resolution))]
+
+def apply_tags(sentence, tags):
+    res = []
+    last = 0
+    for (start, end, word), tag in zip(split_words(sentence), tags):
+        rewrite = apply_tag(word, tag)
+        gap = sentence[last:start]
+        if rewrite == '':
+            # Drop the word together with the whitespace in front of it
+            gap = gap if last == 0 else ''
+        res.append(gap + rewrite)
+        last = end
+    res.append(sentence[last:])
+    return ''.join(res)
+
+class TagVocabulary:
+
+    def __init__(self, tags):
+        self.tags = [KEEP] + [t for t in tags if t != KEEP]
+        self.tag2id = {t: i for i, t in enumerate(self.tags)}
+
+    def __len__(self):
+        return len(self.tags)
+
+    @classmethod
+    def build(cls, raw_sentences, resolutions, min_count=2):
+        counts = Counter(t for r, f in zip(raw_sentences, resolutions) for t in derive_tags(r, f))
+        return cls(sorted(t for t, c in counts.items() if c >= min_count and t != KEEP))
+
+    def encode(self, tags):
+        # Tags outside the learned vocabulary cannot be predicted, they become KEEP
+        return [self.tag2id.get(t, 0) for t in tags]
+
+    def decode(self, ids):
+        return [self.tags[i] for i in ids]
+
+    def coverage(self, raw_sentences, resolutions):
+        # Fraction of sentences whose gold resolution can be produced with this vocabulary
+        ok = [apply_tags(r, self.decode(self.encode(derive_tags(r, f)))) == f for r, f in zip(raw_sentences, resolutions)]
+        return float(np.mean(ok)) if ok else 0.0
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.tags, f, ensure_ascii=False, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+def compute_tagging_metrics(eval_preds):
+    logits, labels = eval_preds
+    if isinstance(logits, tuple):
+        logits = logits[0]
+    preds = logits.argmax(-1)
+    mask = labels != -100
+    correct = (preds == labels) | ~mask
+    return {
+        'tag_accuracy' : float(((preds == labels) & mask).sum() / mask.sum()),
+        'exact_match' : float(correct.all(axis=1).mean()),
+    }
+
+# Encoder-only resolver: one forward pass per batch, the tag of the first sub-token of each word is applied
+class EditTagger:
+
+    def __init__(self, model, tokenizer, vocab, device='auto', batch_size=32):
+        self.device = get_device(device)
+        self.model = model.to(self.device).eval()
+        self.tokenizer = tokenizer
+        self.vocab = vocab
+        self.batch_size = batch_size
+
+    @torch.no_grad()
+    def predict_tags(self, sentences):
+        res = []
+        for i in range(0, len(sentences), self.batch_size):
+            batch = [[w for _, _, w in split_words(s)] for s in sentences[i:i + self.batch_size]]
+            inputs = self.tokenizer(batch, is_split_into_words=True, truncation=True, padding=True, return_tensors='pt')
+            logits = self.model(**inputs.to(self.device)).logits
+            preds = logits.argmax(-1).cpu().numpy()
+            for b, words in enumerate(batch):
+                tags = [KEEP] * len(words)
+                seen = set()
+                for t, word_id in enumerate(inputs.word_ids(b)):
+                    if word_id is not None and word_id not in seen:
+                        seen.add(word_id)
+                        tags[word_id] = self.vocab.tags[preds[b, t]]
+                res.append(tags)
+        return res
+
+    def __call__(self, sentences):
+        sentences = list(sentences)
+        return [apply_tags(s, tags) for s, tags in zip(sentences, self.predict_tags(sentences))]
@@ -4,9 +4,13 @@ import nltk
 from collections import Counter
 import difflib
 import pandas as pd
+from nltk.util import everygrams
+from sacrebleu.tokenizers.tokenizer_13a import Tokenizer13a
 
-def encode_decode(series, tokenizer):
-    return [tokenizer.decode(s, skip_special_tokens=True) for s in tokenizer(series.tolist())['input_ids']]
+def encode_decode(series, tokenizer, cache=None):
+    if cache is not None:
+        return cache.encode_decode(series, tokenizer)
+    return tokenizer.batch_decode(tokenizer(list(series))['input_ids'], skip_special_tokens=True)
 
 def error_analysis(predictions, gt_resolutions, original_sentences):
     d = difflib.Differ()
@@ -34,8 +38,30 @@ def error_analysis(predictions, gt_resolutions, original_sentences):
         res.append(entry)
     return pd.DataFrame(res)
 
+def edit_distance(a, b):
+    # Levenshtein distance (same as nltk.edit_distance without transpositions), one numpy pass per character of a:
+    # insertions within a row are resolved with a running minimum of row[i] - i
+    if len(a) < len(b):
+        a, b = b, a
+    if not b:
+        return len(a)
+    b = np.frombuffer(b.encode('utf-32-le'), dtype=np.uint32)
+    offsets = np.arange(len(b) + 1)
+    row = offsets.copy()
+    for i, c in enumerate(a, 1):
+        candidates = np.empty_like(row)
+        candidates[0] = i
+        candidates[1:] = np.minimum(row[1:] + 1, row[:-1] + (b != ord(c)))
+        row = np.minimum.accumulate(candidates - offsets) + offsets
+    return int(row[-1])
+
 def relative_edit_distance(p, g, o):
-    ed = nltk.edit_distance
+    if p == g:
+        return 1
+    if p == o:
+        # k == 0 and l == d
+        return 0
+    ed = edit_distance
     d = ed(p,g)
     k = ed(p,o)
     l = ed(o,g)
@@ -61,6 +87,165 @@ def get_scores(error_analysis_results, key, detailed=False):
     else:
         return { f"{key}/{k}":res[k] for k in ['exact_match', 'gleu', 'edit_distance_rel']} 
     
+def gleu_statistics(pred, ref, tokenizer=Tokenizer13a(), min_len=1, max_len=4):
+    # Sufficient statistics of corpus GLEU (as in nltk / evaluate's google_bleu): matching n-grams and max(|pred n-grams|, |ref n-grams|)
+    pred_ngrams = Counter(everygrams(tokenizer(pred.strip()).split(), min_len, max_len))
+    ref_ngrams = Counter(everygrams(tokenizer(ref.strip()).split(), min_len, max_len))
+    matches = sum((pred_ngrams & ref_ngrams).values())
+    total = max(sum(pred_ngrams.values()), sum(ref_ngrams.values()))
+    return matches, total
+
+def get_sentence_scores(error_analysis_results):
+    preds, refs, origs = error_analysis_results['pred'], error_analysis_results['ground_truth'], error_analysis_results['original']
+    gleu_stats = np.array([gleu_statistics(p, g) for p, g in zip(preds, refs)], dtype=float).reshape(-1, 2)
+    return {
+        'exact_match' : (preds.values == refs.values).astype(float),
+        'edit_distance_rel' : np.array([relative_edit_distance(p, g, o) for p, g, o in zip(preds, refs, origs)], dtype=float),
+        'gleu_matches' : gleu_stats[:, 0],
+        'gleu_total' : gleu_stats[:, 1],
+    }
+
+def _safe_div(a, b):
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    return np.divide(a, b, out=np.zeros(np.broadcast(a, b).shape), where=b > 0)
+
+def _aggregate(weights, sentence_scores):
+    # weights: (n_resamples, n_sentences) matrix, every resampled statistic is a matrix product
+    n = weights.sum(axis=1)
+    return {
+        'exact_match' : weights @ sentence_scores['exact_match'] / n,
+        'gleu' : _safe_div(weights @ sentence_scores['gleu_matches'], weights @ sentence_scores['gleu_total']),
+        'edit_distance_rel' : weights @ sentence_scores['edit_distance_rel'] / n,
+    }
+
+def _point_estimates(sentence_scores):
+    return {k: v[0] for k, v in _aggregate(np.ones((1, len(sentence_scores['exact_match']))), sentence_scores).items()}
+
+def _bootstrap_weights(rng, n, size):
+    # Resampling n sentences with replacement, expressed as counts per sentence
+    idx = rng.integers(0, n, size=(size, n)) + np.arange(size)[:, None] * n
+    return np.bincount(idx.ravel(), minlength=size * n).reshape(size, n).astype(float)
+
+def _permuted_differences(swap, scores_a, scores_b):
+    # swap: (n_resamples, n_sentences) 0/1 matrix, 1 exchanges the outputs of both systems for that sentence
+    n = swap.shape[1]
+    sums = {}
+    for k in scores_a.keys():
+        delta = swap @ (scores_a[k] - scores_b[k])
+        sums[k] = (scores_a[k].sum() - delta, scores_b[k].sum() + delta)
+    res = {k: (sums[k][0] - sums[k][1]) / n for k in ['exact_match', 'edit_distance_rel']}
+    (matches_a, matches_b), (total_a, total_b) = sums['gleu_matches'], sums['gleu_total']
+    res['gleu'] = _safe_div(matches_a, total_a) - _safe_div(matches_b, total_b)
+    return res
+
+def bootstrap_scores(error_analysis_results, key, n_resamples=1000, alpha=0.05, seed=42, chunk_size=1000):
+    sentence_scores = get_sentence_scores(error_analysis_results)
+    n = len(sentence_scores['exact_match'])
+    rng = np.random.default_rng(seed)
+
+    samples = {k: [] for k in ['exact_match', 'gleu', 'edit_distance_rel']}
+    for start in range(0, n_resamples, chunk_size):
+        weights = _bootstrap_weights(rng, n, min(chunk_size, n_resamples - start))
+        for k, v in _aggregate(weights, sentence_scores).items():
+            samples[k].append(v)
+
+    point = _point_estimates(sentence_scores)
+    res = {}
+    for k, v in samples.items():
+        v = np.concatenate(v)
+        res[f"{key}/{k}"] = point[k]
+        res[f"{key}/{k}_ci_low"] = np.quantile(v, alpha / 2)
+        res[f"{key}/{k}_ci_high"] = np.quantile(v, 1 - alpha / 2)
+    return res
+
+def paired_test(errors_a, errors_b, key, n_resamples=10000, alpha=0.05, seed=42, chunk_size=1000):
+    # Paired approximate randomisation test and paired bootstrap CI for the difference a - b
+    if len(errors_a) != len(errors_b) or not (errors_a['ground_truth'].values == errors_b['ground_truth'].values).all():
+        raise ValueError('Error analysis results must be aligned on the same sentences')
+
+    scores_a = get_sentence_scores(errors_a)
+    scores_b = get_sentence_scores(errors_b)
+    n = len(errors_a)
+    rng = np.random.default_rng(seed)
+
+    point_a, point_b = _point_estimates(scores_a), _point_estimates(scores_b)
+    observed = {k: point_a[k] - point_b[k] for k in point_a.keys()}
+
+    n_extreme = {k: 0 for k in observed.keys()}
+    diffs = {k: [] for k in observed.keys()}
+    for start in range(0, n_resamples, chunk_size):
+        size = min(chunk_size, n_resamples - start)
+
+        swap = rng.integers(0, 2, size=(size, n)).astype(float)
+        for k, v in _permuted_differences(swap, scores_a, scores_b).items():
+            n_extreme[k] += (np.abs(v) >= abs(observed[k]) - 1e-12).sum()
+
+        weights = _bootstrap_weights(rng, n, size)
+        boot_a, boot_b = _aggregate(weights, scores_a), _aggregate(weights, scores_b)
+        for k in observed.keys():
+            diffs[k].append(boot_a[k] - boot_b[k])
+
+    res = {}
+    for k in observed.keys():
+        d = np.concatenate(diffs[k])
+        res[f"{key}/{k}_diff"] = observed[k]
+        res[f"{key}/{k}_diff_ci_low"] = np.quantile(d, alpha / 2)
+        res[f"{key}/{k}_diff_ci_high"] = np.quantile(d, 1 - alpha / 2)
+        res[f"{key}/{k}_p_value"] = (n_extreme[k] + 1) / (n_resamples + 1)
+    return res
+
+def candidate_scores(candidates, gt_resolutions, original_sentences):
+    # (n_sentences, k) matrix of relative edit distance scores for ranked candidates, exact matches and
+    # unchanged copies are resolved with array comparisons, every other distinct triple is scored once
+    candidates = np.array([list(c) for c in candidates], dtype=object)
+    gt = np.array(list(gt_resolutions), dtype=object)[:, None]
+    orig = np.array(list(original_sentences), dtype=object)[:, None]
+
+    scores = np.full(candidates.shape, np.nan)
+    scores[candidates == orig] = 0.0
+    scores[candidates == gt] = 1.0
+    distances = {}
+    for i, j in np.argwhere(np.isnan(scores)):
+        triple = (candidates[i, j], gt[i, 0], orig[i, 0])
+        if triple not in distances:
+            distances[triple] = relative_edit_distance(*triple)
+        scores[i, j] = distances[triple]
+    return scores
+
+def top_k_oracle(candidates, gt_resolutions, original_sentences, ks=None):
+    # Best of the first k ranked candidates for every k (ties go to the higher ranked candidate), all computed
+    # from the same candidate lists, e.g. a single beam search with k_max beams
+    gt_resolutions, original_sentences = list(gt_resolutions), list(original_sentences)
+    candidates = np.array([list(c) for c in candidates], dtype=object)
+    scores = candidate_scores(candidates, gt_resolutions, original_sentences)
+    rows = np.arange(len(candidates))
+    return {
+        k : error_analysis(candidates[rows, scores[:, :k].argmax(axis=1)], gt_resolutions, original_sentences)
+        for k in (ks or range(1, candidates.shape[1] + 1))
+    }
+
+def get_top_k_scores(top_k_errors, key, detailed=False):
+    res = {}
+    for k, errors in top_k_errors.items():
+        res.update(get_scores(errors, f"{key}/top{k}", detailed))
+    return res
+
+def argmax_logits(logits, labels):
+    # preprocess_logits_for_metrics: keeps only the predicted token ids instead of the (batch, length, vocab) logits
+    if isinstance(logits, tuple):
+        logits = logits[0]
+    return logits.argmax(-1)
+
+def compute_teacher_forced_metrics(eval_preds):
+    # Token accuracy and sequence exact match of the argmax predictions given the reference prefix
+    preds, labels = eval_preds
+    mask = labels != -100
+    correct = (preds == labels) & mask
+    return {
+        'token_accuracy' : float(correct.sum() / mask.sum()),
+        'exact_match' : float((correct | ~mask).all(axis=1).mean()),
+    }
+
 def postprocess_text(preds, labels):
     preds = [pred.strip() for pred in preds]
     labels = [[label.strip()] for label in labels]
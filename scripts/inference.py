@@ -0,0 +1,181 @@
+import logging
+import time
+
+import numpy as np
+import torch
+
+from cache_util import model_fingerprint, tokenizer_fingerprint
+from speculative import copy_speculative_generate
+
+log = logging.getLogger(__name__)
+
+def get_device(device='auto'):
+    if device is None or device == 'auto':
+        return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    return torch.device(device)
+
+class GenerationStats:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.batch_seconds = []
+        self.batch_sizes = []
+        self.cache_hits = 0
+        self.decoder_steps = 0
+        self.generated_tokens = 0
+
+    def add(self, seconds, n_sentences):
+        self.batch_seconds.append(seconds)
+        self.batch_sizes.append(n_sentences)
+
+    def report(self, key='inference'):
+        if not self.batch_sizes:
+            return {f'{key}/cache_hits' : self.cache_hits} if self.cache_hits else {}
+        seconds = np.array(self.batch_seconds)
+        sizes = np.array(self.batch_sizes)
+        # Within a batch, every sentence waits for the whole batch
+        latencies = np.repeat(seconds, sizes) * 1000
+        res = {
+            f'{key}/n_sentences' : int(sizes.sum()),
+            f'{key}/n_batches' : len(sizes),
+            f'{key}/seconds' : float(seconds.sum()),
+            f'{key}/sentences_per_s' : float(sizes.sum() / seconds.sum()) if seconds.sum() > 0 else float('nan'),
+            f'{key}/latency_p50_ms' : float(np.percentile(latencies, 50)),
+            f'{key}/latency_p90_ms' : float(np.percentile(latencies, 90)),
+            f'{key}/latency_p99_ms' : float(np.percentile(latencies, 99)),
+            f'{key}/cache_hits' : self.cache_hits,
+        }
+        if self.decoder_steps:
+            res[f'{key}/decoder_steps_per_sentence'] = float(self.decoder_steps / sizes.sum())
+            res[f'{key}/tokens_per_decoder_step'] = self.generated_tokens / self.decoder_steps
+        return res
+
+# Length-sorted, token-budgeted batched generation that returns outputs in input order
+class BatchedGenerator:
+
+    def __init__(self, model, tokenizer, max_length, device='auto', max_batch_tokens=8192, max_batch_size=64, cache=None, copy_draft_tokens=0, return_scores=False, **generate_kwargs):
+        self.device = get_device(device)
+        self.model = model.to(self.device).eval()
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.generate_kwargs = generate_kwargs
+        self.stats = GenerationStats()
+        self.cache = cache
+        self._fingerprints = None
+        # Input-copy speculative decoding, only equivalent to plain greedy search
+        self.copy_draft_tokens = copy_draft_tokens
+        if copy_draft_tokens and (generate_kwargs.get('num_beams', 1) > 1 or generate_kwargs.get('do_sample', False)):
+            raise ValueError('Input-copy speculative decoding requires greedy decoding (num_beams=1, do_sample=False)')
+        # Outputs become [text, score] pairs, score is the (length-normalised for beam search) log-probability of the sequence
+        self.return_scores = return_scores
+        if copy_draft_tokens and return_scores:
+            raise ValueError('Sequence scores are not available with input-copy speculative decoding')
+
+    @classmethod
+    def from_config(cls, model, tokenizer, config, **kwargs):
+        inference_config = config.get('inference', {})
+        params = dict(
+            max_length=config.generation_max_length,
+            device=inference_config.get('device', 'auto'),
+            max_batch_tokens=inference_config.get('max_batch_tokens', 8192),
+            max_batch_size=inference_config.get('max_batch_size', 64),
+            copy_draft_tokens=inference_config.get('copy_draft_tokens', 0),
+        )
+        params.update(kwargs)
+        return cls(model, tokenizer, **params)
+
+    @property
+    def num_return_sequences(self):
+        return self.generate_kwargs.get('num_return_sequences', 1)
+
+    def _batches(self, lengths):
+        # Longest first, so that the first sentence of a batch determines its padded length
+        order = np.argsort(-np.asarray(lengths), kind='stable')
+        beams = self.generate_kwargs.get('num_beams', 1)
+        # Speculative decoding runs sentence by sentence
+        max_batch_size = 1 if self.copy_draft_tokens else self.max_batch_size
+        batch = []
+        for i in order:
+            batch_len = lengths[batch[0]] if batch else lengths[i]
+            if batch and ((len(batch) + 1) * batch_len * beams > self.max_batch_tokens or len(batch) == max_batch_size):
+                yield batch
+                batch = []
+            batch.append(i)
+        if batch:
+            yield batch
+
+    def _generate_copy_speculative(self, sentences):
+        output_ids = []
+        for sentence in sentences:
+            inputs = self.tokenizer(sentence, return_tensors='pt').to(self.device)
+            ids, steps = copy_speculative_generate(self.model, inputs['input_ids'], inputs['attention_mask'], self.max_length, self.copy_draft_tokens)
+            self.stats.decoder_steps += steps
+            self.stats.generated_tokens += len(ids) - 1
+            output_ids.append(ids)
+        return self.tokenizer.batch_decode(output_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+
+    @torch.no_grad()
+    def _generate_batch(self, sentences):
+        if self.copy_draft_tokens:
+            return self._generate_copy_speculative(sentences)
+        inputs = self.tokenizer(sentences, padding=True, return_tensors='pt').to(self.device)
+        if not self.return_scores:
+            output_ids = self.model.generate(**inputs, max_length=self.max_length, **self.generate_kwargs)
+            return self.tokenizer.batch_decode(output_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+
+        out = self.model.generate(**inputs, max_length=self.max_length, return_dict_in_generate=True, output_scores=True, **self.generate_kwargs)
+        if getattr(out, 'sequences_scores', None) is not None:
+            scores = out.sequences_scores
+        else:
+            transition_scores = self.model.compute_transition_scores(out.sequences, out.scores, normalize_logits=True)
+            # Positions after the end of shorter sequences are padding
+            generated = out.sequences[:, -transition_scores.shape[1]:]
+            scores = transition_scores.masked_fill(generated == self.tokenizer.pad_token_id, 0).sum(-1)
+        texts = self.tokenizer.batch_decode(out.sequences, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+        return [[t, s] for t, s in zip(texts, scores.tolist())]
+
+    def _cache_keys(self, sentences):
+        if self._fingerprints is None:
+            # Computed once, the generator assumes that the weights do not change afterwards
+            self._fingerprints = (model_fingerprint(self.model), tokenizer_fingerprint(self.tokenizer))
+        params = dict(self.generate_kwargs, return_scores=True) if self.return_scores else self.generate_kwargs
+        return [self.cache.key(*self._fingerprints, s, self.max_length, params) for s in sentences]
+
+    def generate(self, sentences):
+        sentences = list(sentences)
+        results = [None] * len(sentences)
+
+        todo = list(range(len(sentences)))
+        if self.cache is not None:
+            keys = self._cache_keys(sentences)
+            cached = self.cache.get_many(keys)
+            for i, key in enumerate(keys):
+                if key in cached:
+                    results[i] = cached[key]
+            todo = [i for i in todo if results[i] is None]
+            self.stats.cache_hits += len(sentences) - len(todo)
+
+        if todo:
+            self._generate(sentences, todo, results)
+            if self.cache is not None:
+                self.cache.set_many({keys[i]: results[i] for i in todo})
+
+        return results
+
+    def _generate(self, sentences, indices, results):
+        lengths = [len(ids) for ids in self.tokenizer([sentences[i] for i in indices])['input_ids']]
+        k = self.num_return_sequences
+
+        for batch in self._batches(lengths):
+            start = time.perf_counter()
+            decoded = self._generate_batch([sentences[indices[b]] for b in batch])
+            self.stats.add(time.perf_counter() - start, len(batch))
+            for j, b in enumerate(batch):
+                results[indices[b]] = decoded[j] if k == 1 else decoded[j * k:(j + 1) * k]
+
+    def __call__(self, sentences):
+        return self.generate(sentences)
@@ -0,0 +1,248 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+
+from cache_util import LLMCache
+
+log = logging.getLogger(__name__)
+
+class RetryableError(Exception):
+    pass
+
+# Backends turn (model, prompt, params) into {'text' : str, 'usage' : {'prompt_tokens' : int, 'completion_tokens' : int}}.
+# A prompt is either a string (completion API) or a list of {'role', 'content'} messages (chat API).
+# Backends raise RetryableError for rate limits and transient failures, everything else fails the request
+class Backend:
+
+    async def complete(self, model, prompt, params):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+# OpenAI API with the openai<1.0 client used in the notebooks
+class OpenAIBackend(Backend):
+
+    def __init__(self, api_key=None, timeout=60):
+        import openai
+        self.openai = openai
+        if api_key:
+            openai.api_key = api_key
+        self.timeout = timeout
+
+    async def complete(self, model, prompt, params):
+        openai = self.openai
+        try:
+            if isinstance(prompt, str):
+                response = await openai.Completion.acreate(model=model, prompt=prompt, request_timeout=self.timeout, **params)
+                text = response['choices'][0]['text']
+            else:
+                response = await openai.ChatCompletion.acreate(model=model, messages=prompt, request_timeout=self.timeout, **params)
+                text = response['choices'][0]['message']['content']
+        except (openai.error.RateLimitError, openai.error.APIError, openai.error.Timeout,
+                openai.error.ServiceUnavailableError, openai.error.APIConnectionError) as e:
+            raise RetryableError(str(e)) from e
+        return {'text' : text, 'usage' : dict(response.get('usage', {}))}
+
+# Any HTTP server that accepts {'model', 'prompt', 'params'} and answers with {'text', 'usage'},
+# e.g. a local mock server or a locally hosted model
+class HTTPBackend(Backend):
+
+    def __init__(self, url, timeout=60):
+        self.url = url
+        self.timeout = timeout
+        self.session = None
+
+    async def complete(self, model, prompt, params):
+        import aiohttp
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        try:
+            async with self.session.post(self.url, json={'model' : model, 'prompt' : prompt, 'params' : params}) as response:
+                if response.status == 429 or response.status >= 500:
+                    raise RetryableError(f'HTTP {response.status}')
+                response.raise_for_status()
+                res = await response.json()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            raise RetryableError(str(e)) from e
+        return {'text' : res['text'], 'usage' : res.get('usage', {})}
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+# Wraps a plain (sync or async) function fn(model, prompt, params) -> str, for tests and offline runs
+class CallableBackend(Backend):
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    async def complete(self, model, prompt, params):
+        text = self.fn(model, prompt, params)
+        if asyncio.iscoroutine(text):
+            text = await text
+        return {'text' : text, 'usage' : {}}
+
+class TokenBucket:
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = None
+        self.loop = None
+
+    async def acquire(self, tokens=1):
+        # The blocking client starts a new event loop per call, locks are bound to their loop
+        if self.loop is not asyncio.get_running_loop():
+            self.loop = asyncio.get_running_loop()
+            self.lock = asyncio.Lock()
+        tokens = min(tokens, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+class LLMStats:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.n_prompts = 0
+        self.n_requests = 0
+        self.n_cached = 0
+        self.n_retries = 0
+        self.n_failed = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.seconds = 0.0
+
+    def report(self, key='llm'):
+        return {f'{key}/{k}' : v for k, v in vars(self).items()}
+
+def estimate_tokens(prompt):
+    # Rough estimate for rate limiting only (about 4 characters per token)
+    text = prompt if isinstance(prompt, str) else ' '.join(m['content'] for m in prompt)
+    return len(text) // 4 + 1
+
+# Concurrent, rate-limited and cached requests to an LLM backend
+class LLMClient:
+
+    def __init__(self, backend, model, cache=None, max_concurrency=8, requests_per_minute=None, tokens_per_minute=None,
+                 max_retries=5, initial_backoff=1.0, max_backoff=60.0, **params):
+        self.backend = backend
+        self.model = model
+        self.params = params
+        self.cache = cache
+        self.max_concurrency = max_concurrency
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.stats = LLMStats()
+
+    @classmethod
+    def from_config(cls, backend, config, model, cache_dir=None, **params):
+        llm_config = config.get('llm', {})
+        cache = LLMCache(cache_dir / 'llm.sqlite') if cache_dir and llm_config.get('cache', True) else None
+        return cls(
+            backend, model, cache=cache,
+            max_concurrency=llm_config.get('max_concurrency', 8),
+            requests_per_minute=llm_config.get('requests_per_minute'),
+            tokens_per_minute=llm_config.get('tokens_per_minute'),
+            max_retries=llm_config.get('max_retries', 5),
+            **params)
+
+    @staticmethod
+    def messages(turns):
+        # [(role, text), ...] as in the notebooks -> chat API messages
+        return [{'role' : role, 'content' : text} for role, text in turns]
+
+    async def _request(self, prompt, params):
+        for attempt in range(self.max_retries + 1):
+            if self.request_bucket:
+                await self.request_bucket.acquire()
+            if self.token_bucket:
+                await self.token_bucket.acquire(estimate_tokens(prompt) + params.get('max_tokens', 0))
+            try:
+                self.stats.n_requests += 1
+                return await self.backend.complete(self.model, prompt, params)
+            except RetryableError as e:
+                if attempt == self.max_retries:
+                    raise
+                self.stats.n_retries += 1
+                # Exponential backoff with full jitter
+                delay = random.uniform(0, min(self.max_backoff, self.initial_backoff * 2 ** attempt))
+                log.warning(f'{e}, retrying in {delay:.1f}s')
+                await asyncio.sleep(delay)
+
+    async def acomplete(self, prompt, semaphore=None, params=None):
+        # params override the request parameters of the client for this prompt
+        params = dict(self.params, **(params or {}))
+        self.stats.n_prompts += 1
+        key = self.cache.key(self.model, prompt, params) if self.cache is not None else None
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.stats.n_cached += 1
+                return dict(cached, cached=True)
+
+        async with semaphore or asyncio.Semaphore(1):
+            try:
+                response = await self._request(prompt, params)
+            except Exception as e:
+                # Failed prompts are not cached, so that a rerun retries them
+                log.error(f'Request failed: {e!r}')
+                self.stats.n_failed += 1
+                return {'text' : None, 'usage' : {}, 'error' : repr(e), 'cached' : False}
+
+        self.stats.prompt_tokens += response['usage'].get('prompt_tokens', 0)
+        self.stats.completion_tokens += response['usage'].get('completion_tokens', 0)
+        if key is not None:
+            self.cache.set(key, response)
+        return dict(response, cached=False)
+
+    async def acomplete_many(self, prompts, params=None):
+        # params: None, one dict for all prompts or one dict per prompt
+        params = params if isinstance(params, list) else [params] * len(prompts)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        start = time.perf_counter()
+        try:
+            return await asyncio.gather(*[self.acomplete(p, semaphore, pp) for p, pp in zip(prompts, params)])
+        finally:
+            self.stats.seconds += time.perf_counter() - start
+            await self.backend.close()
+
+    def complete_many(self, prompts, params=None):
+        # Blocking entry point, also works inside Jupyter where an event loop is already running
+        prompts = list(prompts)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.acomplete_many(prompts, params))
+        res = {}
+        def run():
+            try:
+                res['value'] = asyncio.run(self.acomplete_many(prompts, params))
+            except BaseException as e:
+                res['error'] = e
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        if 'error' in res:
+            raise res['error']
+        return res['value']
+
+    def complete(self, prompt, params=None):
+        return self.complete_many([prompt], params)[0]
@@ -0,0 +1,64 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import aiohttp
+import numpy as np
+import pandas as pd
+
+# Load generator for serve.py: `concurrency` clients send single-sentence requests back to back
+async def client(session, url, sentences, latencies, errors):
+    for sentence in sentences:
+        start = time.perf_counter()
+        try:
+            async with session.post(url, json={'sentence' : sentence}) as response:
+                response.raise_for_status()
+                await response.json()
+            latencies.append(time.perf_counter() - start)
+        except aiohttp.ClientError:
+            errors.append(sentence)
+
+async def run(base_url, sentences, concurrency):
+    latencies, errors = [], []
+    async with aiohttp.ClientSession() as session:
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            client(session, f'{base_url}/resolve', sentences[i::concurrency], latencies, errors)
+            for i in range(concurrency)
+        ])
+        seconds = time.perf_counter() - start
+        async with session.get(f'{base_url}/metrics') as response:
+            server_metrics = await response.json()
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'n_requests' : len(sentences),
+        'n_errors' : len(errors),
+        'concurrency' : concurrency,
+        'seconds' : seconds,
+        'requests_per_s' : len(latencies) / seconds,
+        'client_latency_p50_ms' : float(np.percentile(latencies, 50)) if len(latencies) else None,
+        'client_latency_p99_ms' : float(np.percentile(latencies, 99)) if len(latencies) else None,
+    }, server_metrics
+
+def main():
+    parser = argparse.ArgumentParser(description='Sends concurrent /resolve requests to a running serve.py')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--tsv', default='data/ellipses/ggponc_ellipses_compounds.tsv', help='TSV file with a raw_sentence column')
+    parser.add_argument('--n_requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    sentences = pd.read_csv(args.tsv, sep='\t').raw_sentence.tolist()
+    random.Random(args.seed).shuffle(sentences)
+    sentences = (sentences * (args.n_requests // len(sentences) + 1))[:args.n_requests]
+
+    for concurrency in args.concurrency:
+        client_metrics, server_metrics = asyncio.run(run(args.url.rstrip('/'), sentences, concurrency))
+        print(json.dumps({'client' : client_metrics, 'server' : server_metrics}, indent=1))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import json
+import logging
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import psutil
+import torch
+from transformers import TrainerCallback
+
+log = logging.getLogger(__name__)
+
+def _rss_mb(process):
+    return process.memory_info().rss / 2 ** 20
+
+def _max_rss_mb():
+    # High-water mark of the process, in KB on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10
+
+# Named phases (e.g. tokenization, train/epoch_1, eval/generation) with wall time, CPU time of the process (all threads)
+# and peak RSS while the phase was open, sampled every memory_interval_ms. Phases can be nested or overlap.
+# A torch.profiler trace (Chrome trace format) is recorded for the phase named torch_profiler_phase
+class PhaseProfiler:
+
+    def __init__(self, output_path=None, torch_profiler_phase=None, trace_dir='profiles', memory_interval_ms=50, log_fn=None, enabled=True):
+        self.output_path = Path(output_path) if output_path else None
+        self.torch_profiler_phase = torch_profiler_phase
+        self.trace_dir = Path(trace_dir)
+        self.memory_interval = memory_interval_ms / 1000
+        self.log_fn = log_fn
+        self.enabled = enabled
+        self.phases = []
+        self._open = {}
+        self._torch_profiler = None
+        self._process = psutil.Process()
+        self._lock = threading.Lock()
+        self._stop_sampling = threading.Event()
+        self._sampler = None
+        self._start = time.perf_counter()
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        profiling_config = config.get('profiling', {})
+        params = dict(
+            output_path=profiling_config.get('output', 'profile.json'),
+            torch_profiler_phase=profiling_config.get('torch_profiler_phase'),
+            trace_dir=profiling_config.get('trace_dir', 'profiles'),
+            memory_interval_ms=profiling_config.get('memory_interval_ms', 50),
+            enabled=profiling_config.get('enabled', True),
+        )
+        params.update(kwargs)
+        return cls(**params)
+
+    def _sample_memory(self):
+        while not self._stop_sampling.wait(self.memory_interval):
+            rss = _rss_mb(self._process)
+            with self._lock:
+                for phase in self._open.values():
+                    phase['peak_rss_mb'] = max(phase['peak_rss_mb'], rss)
+
+    def start(self, name):
+        if not self.enabled:
+            return
+        if name in self._open:
+            raise ValueError(f'Phase {name} is already running')
+        if self._sampler is None:
+            self._sampler = threading.Thread(target=self._sample_memory, daemon=True)
+            self._sampler.start()
+        rss = _rss_mb(self._process)
+        with self._lock:
+            self._open[name] = {
+                'name' : name,
+                'start_s' : time.perf_counter() - self._start,
+                'rss_start_mb' : rss,
+                'peak_rss_mb' : rss,
+                '_wall' : time.perf_counter(),
+                '_cpu' : time.process_time(),
+            }
+        if name == self.torch_profiler_phase:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._torch_profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self._torch_profiler.start()
+
+    def stop(self, name):
+        if not self.enabled:
+            return
+        wall, cpu, rss = time.perf_counter(), time.process_time(), _rss_mb(self._process)
+        with self._lock:
+            phase = self._open.pop(name)
+        phase['wall_s'] = wall - phase.pop('_wall')
+        phase['cpu_s'] = cpu - phase.pop('_cpu')
+        phase['rss_end_mb'] = rss
+        phase['peak_rss_mb'] = max(phase['peak_rss_mb'], rss)
+        self.phases.append(phase)
+
+        # The trace export is not part of the phase, the recording overhead of the profiler is
+        if name == self.torch_profiler_phase and self._torch_profiler is not None:
+            self._torch_profiler.stop()
+            self.trace_dir.mkdir(parents=True, exist_ok=True)
+            trace = self.trace_dir / (name.replace('/', '_') + '.json')
+            self._torch_profiler.export_chrome_trace(str(trace))
+            log.info(f'torch.profiler trace of {name} written to {trace}\n' +
+                self._torch_profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=20))
+            phase['torch_trace'] = str(trace)
+            self._torch_profiler = None
+
+    @contextmanager
+    def phase(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def report(self, key='profile'):
+        res = {}
+        for phase in self.phases:
+            res[f'{key}/{phase["name"]}/wall_s'] = phase['wall_s']
+            res[f'{key}/{phase["name"]}/cpu_s'] = phase['cpu_s']
+            res[f'{key}/{phase["name"]}/peak_rss_mb'] = phase['peak_rss_mb']
+        if self.phases:
+            res[f'{key}/max_rss_mb'] = _max_rss_mb()
+        return res
+
+    def close(self):
+        # Phases that are still open (e.g. after an exception) are closed and reported as well
+        for name in list(self._open):
+            self.stop(name)
+        self._stop_sampling.set()
+        if not self.enabled or not self.phases:
+            return
+        if self.output_path:
+            with open(self.output_path, 'w') as f:
+                json.dump({'phases' : self.phases, 'max_rss_mb' : _max_rss_mb()}, f, indent=1)
+        if self.log_fn:
+            self.log_fn(self.report())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Training epochs as phases train/epoch_<n>
+class PhaseCallback(TrainerCallback):
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.epoch = None
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        self.epoch = f'train/epoch_{int(state.epoch) + 1}'
+        self.profiler.start(self.epoch)
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        self.profiler.stop(self.epoch)
+        self.epoch = None
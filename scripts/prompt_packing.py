@@ -0,0 +1,105 @@
+import re
+
+from llm_client import estimate_tokens
+
+# Several sentences share one instruction prefix: the sentences are numbered and the model answers with one
+# numbered line per sentence. Sentences whose answer cannot be matched are sent again as single-sentence prompts
+PACK_INSTRUCTION = (
+    "Ich gebe dir gleich mehrere nummerierte Sätze. Löse die Koordinationsellipsen in jedem Satz auf. "
+    "Antworte für jeden Satz in einer eigenen Zeile mit seiner Nummer und dem korrigierten Satz, z.B. \"1) <Satz>\", "
+    "und keiner Erklärung. Gib jeden Satz zurück, auch wenn er unverändert bleibt.\n\n"
+)
+ANSWER_RE = re.compile(r'^\s*(?:Satz\s*)?\(?(\d+)\s*[\).:]\s*(.*?)\s*$', re.MULTILINE)
+
+def strip_quotes(text):
+    text = text.strip()
+    if len(text) > 1 and text[0] == text[-1] and text[0] in '\'"':
+        return text[1:-1].strip()
+    return text
+
+def pack_prompt(prefix, sentences):
+    return prefix + PACK_INSTRUCTION + ''.join(f"{i}) '{s}'\n" for i, s in enumerate(sentences, 1))
+
+def parse_packed_answer(answer, n):
+    # Returns {position : sentence} for all numbers 1..n that occur exactly once with a non-empty sentence
+    found = {}
+    duplicates = set()
+    for m in ANSWER_RE.finditer(answer or ''):
+        i, text = int(m.group(1)) - 1, strip_quotes(m.group(2))
+        if not 0 <= i < n or not text:
+            continue
+        if i in found:
+            duplicates.add(i)
+        found[i] = text
+    return {i: text for i, text in found.items() if i not in duplicates}
+
+class PromptPacker:
+
+    def __init__(self, client, prefix, single_prompt_fn, pack_size=10, max_tokens_per_sentence=100, postprocess=strip_quotes):
+        self.client = client
+        self.prefix = prefix
+        self.single_prompt_fn = single_prompt_fn
+        self.pack_size = pack_size
+        self.max_tokens_per_sentence = max_tokens_per_sentence
+        self.postprocess = postprocess
+        self.reset_stats()
+
+    @classmethod
+    def from_config(cls, client, prefix, single_prompt_fn, config, **kwargs):
+        llm_config = config.get('llm', {})
+        params = dict(
+            pack_size=llm_config.get('pack_size', 10),
+            max_tokens_per_sentence=llm_config.get('max_tokens_per_sentence', 100),
+        )
+        params.update(kwargs)
+        return cls(client, prefix, single_prompt_fn, **params)
+
+    def reset_stats(self):
+        self.n_sentences = 0
+        self.n_packed_requests = 0
+        self.n_fallback = 0
+        self.prompt_tokens = 0
+        self.prompt_tokens_unpacked = 0
+
+    def report(self, key='packing'):
+        n_requests = self.n_packed_requests + self.n_fallback
+        return {
+            f'{key}/pack_size' : self.pack_size,
+            f'{key}/n_sentences' : self.n_sentences,
+            f'{key}/n_requests' : n_requests,
+            f'{key}/n_fallback' : self.n_fallback,
+            f'{key}/request_reduction' : 1 - n_requests / self.n_sentences if self.n_sentences else 0.0,
+            # Estimated prompt tokens, compared to sending every sentence with its own prompt
+            f'{key}/prompt_tokens' : self.prompt_tokens,
+            f'{key}/prompt_tokens_unpacked' : self.prompt_tokens_unpacked,
+            f'{key}/token_reduction' : 1 - self.prompt_tokens / self.prompt_tokens_unpacked if self.prompt_tokens_unpacked else 0.0,
+        }
+
+    def _single(self, sentences):
+        prompts = [self.single_prompt_fn(s) for s in sentences]
+        self.n_fallback += len(prompts)
+        self.prompt_tokens += sum(estimate_tokens(p) for p in prompts)
+        return [self.postprocess(r['text']) if r['text'] is not None else None for r in self.client.complete_many(prompts)]
+
+    def __call__(self, sentences):
+        sentences = list(sentences)
+        self.n_sentences += len(sentences)
+        self.prompt_tokens_unpacked += sum(estimate_tokens(self.single_prompt_fn(s)) for s in sentences)
+        if self.pack_size <= 1:
+            return self._single(sentences)
+
+        packs = [list(range(i, min(i + self.pack_size, len(sentences)))) for i in range(0, len(sentences), self.pack_size)]
+        prompts = [pack_prompt(self.prefix, [sentences[i] for i in pack]) for pack in packs]
+        params = [{'max_tokens' : self.max_tokens_per_sentence * len(pack)} for pack in packs]
+        self.n_packed_requests += len(prompts)
+        self.prompt_tokens += sum(estimate_tokens(p) for p in prompts)
+
+        res = [None] * len(sentences)
+        for pack, response in zip(packs, self.client.complete_many(prompts, params)):
+            for j, text in parse_packed_answer(response['text'], len(pack)).items():
+                res[pack[j]] = self.postprocess(text)
+
+        failed = [i for i, r in enumerate(res) if r is None]
+        for i, text in zip(failed, self._single([sentences[i] for i in failed])):
+            res[i] = text
+        return res
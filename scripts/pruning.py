@@ -0,0 +1,85 @@
+import logging
+import math
+
+import optuna
+from hydra.core.hydra_config import HydraConfig
+from hydra.utils import to_absolute_path
+from omegaconf import OmegaConf
+from transformers import TrainerCallback
+
+log = logging.getLogger(__name__)
+
+PRUNERS = {
+    'median' : optuna.pruners.MedianPruner,
+    'percentile' : optuna.pruners.PercentilePruner,
+    'hyperband' : optuna.pruners.HyperbandPruner,
+    'successive_halving' : optuna.pruners.SuccessiveHalvingPruner,
+}
+
+def _same_value(a, b):
+    if isinstance(a, float) or isinstance(b, float):
+        return math.isclose(float(a), float(b), rel_tol=1e-9)
+    return str(a) == str(b)
+
+def find_running_trial(study, config):
+    # The Optuna sweeper does not pass the trial to the job, the running trial is identified by its sampled parameters
+    matches = [
+        t for t in study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.RUNNING,))
+        if all(_same_value(v, OmegaConf.select(config, k)) for k, v in t.params.items())
+    ]
+    # Trials of crashed sessions stay in RUNNING, take the latest one
+    return max(matches, key=lambda t: t.number) if matches else None
+
+# Reports the evaluation metric after every evaluation to the Optuna trial and stops training when the pruner says so.
+# The Optuna sweeper records every job that returns as COMPLETE, pruned trials are marked with the user attribute pruned
+class OptunaPruningCallback(TrainerCallback):
+
+    def __init__(self, trial, monitor):
+        self.trial = trial
+        self.monitor = monitor
+        self.pruned = False
+        self.checkpoint_epochs = {}
+
+    def on_save(self, args, state, control, **kwargs):
+        # Results of the background evaluation (checkpoint_evaluator.py) arrive later and are reported at their checkpoint's epoch
+        self.checkpoint_epochs[state.global_step] = int(round(state.epoch))
+
+    def on_evaluate(self, args, state, control, metrics=None, **kwargs):
+        if not metrics or self.monitor not in metrics:
+            return
+        if 'eval_checkpoint_step' in metrics:
+            step = self.checkpoint_epochs[metrics['eval_checkpoint_step']]
+        else:
+            step = int(round(state.epoch)) if state.epoch is not None else state.global_step
+        self.trial.report(metrics[self.monitor], step)
+        if self.trial.should_prune():
+            log.info(f'Pruning trial {self.trial.number} after epoch {step} ({self.monitor}={metrics[self.monitor]})')
+            self.trial.set_user_attr('pruned', True)
+            self.pruned = True
+            control.should_training_stop = True
+
+def get_pruning_callback(config, training_args):
+    # None outside of Optuna sweeps with storage or when pruning is disabled
+    pruning_config = config.get('pruning', {})
+    if not pruning_config.get('enabled') or not HydraConfig.initialized():
+        return None
+    hydra_conf = HydraConfig.get()
+    if 'id' not in hydra_conf.job or not hydra_conf.sweeper.get('storage'):
+        return None
+
+    storage = hydra_conf.sweeper.storage
+    if storage.startswith('sqlite:///') and not storage.startswith('sqlite:////'):
+        # Relative to the directory the sweep was started from, the job runs in its own directory
+        storage = 'sqlite:///' + to_absolute_path(storage[len('sqlite:///'):])
+
+    pruner = PRUNERS[pruning_config.get('pruner', 'median')](**pruning_config.get('pruner_kwargs', {}))
+    storage = optuna.storages.get_storage(storage)
+    study = optuna.load_study(study_name=hydra_conf.sweeper.study_name, storage=storage, pruner=pruner)
+    frozen = find_running_trial(study, config)
+    if frozen is None:
+        log.warning('No running Optuna trial matches the job parameters, pruning disabled')
+        return None
+    trial_id = storage.get_trial_id_from_study_id_trial_number(storage.get_study_id_from_name(study.study_name), frozen.number)
+
+    monitor = pruning_config.get('monitor') or 'eval_' + training_args.metric_for_best_model
+    return OptunaPruningCallback(optuna.trial.Trial(study, trial_id), monitor)
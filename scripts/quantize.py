@@ -0,0 +1,129 @@
+import hydra
+from omegaconf import DictConfig, OmegaConf
+from hydra.utils import to_absolute_path
+
+import gc
+import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+import psutil
+import torch
+from transformers import AutoConfig, AutoModelForSeq2SeqLM
+
+from dataset import load_data
+from evaluation import error_analysis, get_scores, encode_decode
+from inference import BatchedGenerator
+from transformers_util import get_tokenizer
+
+log = logging.getLogger(__name__)
+
+QUANTIZED_WEIGHTS = 'quantized_int8.pt'
+
+# Dynamic int8 quantization: weights of all linear layers are stored as int8, activations are quantized on the fly.
+# Quantized kernels only exist for CPU, so the exported model always runs on CPU.
+# The linear layers are replaced in place, the fp32 model is not copied
+def quantize_model(model):
+    return torch.ao.quantization.quantize_dynamic(model.cpu().eval(), {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+def save_quantized(model, tokenizer, path):
+    # Converts model itself, it cannot be used as fp32 model afterwards
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    model.config.save_pretrained(path)
+    tokenizer.save_pretrained(path)
+    # Quantized modules cannot be saved with save_pretrained, store the state dict of the converted model instead
+    torch.save(quantize_model(model).state_dict(), path / QUANTIZED_WEIGHTS)
+    return path
+
+def is_quantized(path):
+    return (Path(path) / QUANTIZED_WEIGHTS).exists()
+
+def load_model(path):
+    # Loads either a regular checkpoint or an int8 export created with save_quantized
+    if not is_quantized(path):
+        return AutoModelForSeq2SeqLM.from_pretrained(path)
+    model = quantize_model(AutoModelForSeq2SeqLM.from_config(AutoConfig.from_pretrained(path)))
+    model.load_state_dict(torch.load(Path(path) / QUANTIZED_WEIGHTS, weights_only=False))
+    return model
+
+# Weight files only, training checkpoints also contain the optimizer and scheduler states
+WEIGHT_FILES = ['pytorch_model*.bin', 'model*.safetensors', QUANTIZED_WEIGHTS]
+
+def model_size_mb(path):
+    return sum(f.stat().st_size for pattern in WEIGHT_FILES for f in Path(path).glob(pattern)) / 2 ** 20
+
+def rss_mb():
+    return psutil.Process(os.getpid()).memory_info().rss / 2 ** 20
+
+def benchmark(path, tokenizer, sample, config, key, num_threads=None):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    gc.collect()
+    rss_before = rss_mb()
+    model = load_model(path)
+    rss_model = rss_mb()
+
+    generator = BatchedGenerator.from_config(model, tokenizer, config, device='cpu')
+    pred = generator(sample.raw_sentence)
+    errors = error_analysis(pred, encode_decode(sample.full_resolution, tokenizer), encode_decode(sample.raw_sentence, tokenizer))
+
+    res = {
+        f'{key}/model_rss_mb' : rss_model - rss_before,
+        f'{key}/inference_rss_mb' : rss_mb() - rss_before,
+        f'{key}/model_size_mb' : model_size_mb(path),
+    }
+    res.update(get_scores(errors, key))
+    res.update(generator.stats.report(key))
+
+    del generator, model
+    gc.collect()
+    return res
+
+def benchmark_isolated(*args, **kwargs):
+    # Every variant is benchmarked in a fresh process, so that its memory numbers do not depend on the
+    # models loaded (and memory kept by the allocator) before it
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(benchmark, *args, **kwargs).result()
+
+@hydra.main(config_path='..', config_name='experiment.yaml', version_base="1.2")
+def main(config: DictConfig):
+    log.info(OmegaConf.to_yaml(config.quantization))
+    checkpoint = to_absolute_path(config.quantization.checkpoint)
+    output_path = Path(to_absolute_path(config.quantization.output_path))
+    num_threads = config.quantization.get('num_threads') or torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+
+    tokenizer = get_tokenizer(config)
+    log.info(f'Quantizing {checkpoint} to {output_path}')
+    model = AutoModelForSeq2SeqLM.from_pretrained(checkpoint)
+    save_quantized(model, tokenizer, output_path)
+    del model
+    gc.collect()
+
+    _, val_df, _ = load_data(
+        to_absolute_path(config.data.cnf_tsv_path),
+        to_absolute_path(config.data.controls_tsv_path) if config.data.controls_tsv_path else None,
+        sample_frac=config.get("sample", None))
+
+    scores = {}
+    for key, path in [('fp32', checkpoint), ('int8', output_path)]:
+        log.info(f'Benchmarking {key} on {len(val_df)} dev sentences')
+        scores.update(benchmark_isolated(path, tokenizer, val_df, config, key, num_threads))
+
+    report = pd.DataFrame({
+        k : {metric.split('/', 1)[1] : v for metric, v in scores.items() if metric.startswith(k + '/')}
+        for k in ['fp32', 'int8']
+    })
+    log.info('\n' + report.to_string())
+    with open(output_path / 'benchmark.json', 'w') as f:
+        json.dump(scores, f, indent=1)
+
+    return scores['int8/exact_match']
+
+if __name__ == "__main__":
+    main()
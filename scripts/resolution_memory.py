@@ -0,0 +1,186 @@
+import json
+from collections import Counter, defaultdict, deque
+
+from edit_tagging import split_words, word_targets
+from span_resolution import find_ellipsis_spans
+
+# Multi-pattern exact string matching in a single pass over the text
+class AhoCorasick:
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]] # lengths of the patterns ending in each state
+        for pattern in patterns:
+            self._add(pattern)
+        self._build()
+
+    def _add(self, pattern):
+        state = 0
+        for c in pattern:
+            if c not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][c] = len(self.goto) - 1
+            state = self.goto[state][c]
+        self.output[state].append(len(pattern))
+
+    def _build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, child in self.goto[state].items():
+                queue.append(child)
+                f = self.fail[state]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[child] = self.goto[f][c] if c in self.goto[f] and self.goto[f][c] != child else 0
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find_all(self, text):
+        # (start, end) of all pattern occurrences, including overlapping ones
+        state = 0
+        for i, c in enumerate(text):
+            while state and c not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(c, 0)
+            for length in self.output[state]:
+                yield i + 1 - length, i + 1
+
+def mine_phrases(raw_sentence, resolution, max_gap=3):
+    # (ellipsis phrase, resolved phrase) pairs of a sentence, only if every edit lies inside a detected ellipsis span
+    words = split_words(raw_sentence)
+    targets = word_targets(raw_sentence, resolution)
+    spans = find_ellipsis_spans(raw_sentence, max_gap)
+    in_span = [any(s <= start < e for s, e in spans) for start, _, _ in words]
+    if any(t != w for (_, _, w), t, inside in zip(words, targets, in_span) if not inside):
+        return []
+    res = []
+    for s, e in spans:
+        inside = [(end, t) for (start, end, _), t in zip(words, targets) if s <= start < e]
+        resolved = ' '.join(t for _, t in inside if t)
+        # The trailing punctuation of the last word is not part of the span and has to be kept by the resolution
+        punctuation = raw_sentence[e:inside[-1][0]]
+        if not resolved.endswith(punctuation):
+            return []
+        res.append((raw_sentence[s:e], resolved[:len(resolved) - len(punctuation)]))
+    return res
+
+# Phrase-level memory of resolved ellipses ("Chemo- und Strahlentherapie" -> "Chemotherapie und Strahlentherapie")
+class ResolutionMemory:
+
+    def __init__(self, phrases=None, min_count=1):
+        self.counts = defaultdict(Counter)
+        self.min_count = min_count
+        self._phrases = None
+        self._automaton = None
+        for phrase, resolved in (phrases or {}).items():
+            self.counts[phrase][resolved] += min_count
+
+    @classmethod
+    def from_pairs(cls, raw_sentences, resolutions, min_count=1, max_gap=3):
+        memory = cls(min_count=min_count)
+        memory.add_pairs(raw_sentences, resolutions, max_gap)
+        return memory
+
+    def add_pairs(self, raw_sentences, resolutions, max_gap=3):
+        # Training pairs or verified model outputs
+        for raw, resolution in zip(raw_sentences, resolutions):
+            for phrase, resolved in mine_phrases(raw, resolution, max_gap):
+                self.counts[phrase][resolved] += 1
+        self._phrases = self._automaton = None
+
+    @property
+    def phrases(self):
+        # Phrases with a single observed resolution, seen at least min_count times
+        if self._phrases is None:
+            self._phrases = {
+                phrase : next(iter(resolutions))
+                for phrase, resolutions in self.counts.items()
+                if len(resolutions) == 1 and sum(resolutions.values()) >= self.min_count
+            }
+        return self._phrases
+
+    def __len__(self):
+        return len(self.phrases)
+
+    @property
+    def automaton(self):
+        if self._automaton is None:
+            self._automaton = AhoCorasick(self.phrases.keys())
+        return self._automaton
+
+    def matches(self, sentence):
+        # Leftmost-longest, non-overlapping occurrences that start and end at word boundaries
+        def boundary(i):
+            return i <= 0 or i >= len(sentence) or not (sentence[i - 1].isalnum() and sentence[i].isalnum())
+        candidates = sorted((s, -e) for s, e in self.automaton.find_all(sentence) if boundary(s) and boundary(e))
+        res = []
+        for s, e in candidates:
+            if not res or s >= res[-1][1]:
+                res.append((s, -e))
+        return res
+
+    def resolve(self, sentence, max_gap=3):
+        # Resolved sentence if every detected ellipsis is covered by the memory, otherwise None
+        spans = find_ellipsis_spans(sentence, max_gap)
+        if not spans:
+            return None
+        matches = self.matches(sentence)
+        if not all(any(ms <= s and e <= me for ms, me in matches) for s, e in spans):
+            return None
+        res = []
+        last = 0
+        for s, e in matches:
+            res.append(sentence[last:s])
+            res.append(self.phrases[sentence[s:e]])
+            last = e
+        res.append(sentence[last:])
+        return ''.join(res)
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'min_count' : self.min_count, 'counts' : self.counts}, f, ensure_ascii=False, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        memory = cls(min_count=data['min_count'])
+        for phrase, resolutions in data['counts'].items():
+            memory.counts[phrase].update(resolutions)
+        return memory
+
+# Exact-match fast path in front of another resolver, sentences not fully covered by the memory go to resolve_fn
+class MemoryResolver:
+
+    def __init__(self, memory, resolve_fn, max_gap=3):
+        self.memory = memory
+        self.resolve_fn = resolve_fn
+        self.max_gap = max_gap
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.n_sentences = 0
+        self.n_hits = 0
+
+    def report(self, key='memory'):
+        return {
+            f'{key}/n_phrases' : len(self.memory),
+            f'{key}/n_sentences' : self.n_sentences,
+            f'{key}/hits' : self.n_hits,
+            f'{key}/misses' : self.n_sentences - self.n_hits,
+            f'{key}/hit_rate' : self.n_hits / self.n_sentences if self.n_sentences else 0.0,
+        }
+
+    def __call__(self, sentences):
+        sentences = list(sentences)
+        res = [self.memory.resolve(s, self.max_gap) for s in sentences]
+        misses = [i for i, r in enumerate(res) if r is None]
+        if misses:
+            for i, r in zip(misses, self.resolve_fn([sentences[i] for i in misses])):
+                res[i] = r
+        self.n_sentences += len(sentences)
+        self.n_hits += len(sentences) - len(misses)
+        return res
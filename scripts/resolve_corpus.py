@@ -0,0 +1,125 @@
+import hydra
+from omegaconf import DictConfig, OmegaConf
+from hydra.utils import to_absolute_path
+
+import itertools
+import json
+import logging
+import os
+import time
+import uuid
+from pathlib import Path
+
+import pandas as pd
+
+from dataset import read_corpus_sentences
+from serve import get_resolver
+
+log = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+
+# Settings that determine the shard contents, a manifest written with other settings cannot be resumed
+MANIFEST_KEYS = ['input_path', 'tokens', 'shard_size', 'checkpoint', 'memory_path']
+
+def shard_name(i):
+    return f'shard-{i:05d}.tsv'
+
+def _write_atomic(path, write_fn):
+    # Readers (and a resumed job) only ever see complete files
+    tmp = path.parent / f'.{path.name}.{uuid.uuid4().hex}'
+    write_fn(tmp)
+    os.replace(tmp, path)
+
+def write_manifest(path, manifest):
+    def write(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=1)
+    _write_atomic(path / MANIFEST, write)
+
+def load_manifest(path, settings):
+    # Completed shards of a previous run with the same settings, shards without their output file are redone
+    manifest_file = Path(path) / MANIFEST
+    if not manifest_file.exists():
+        return dict(settings, shards={}, complete=False)
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    changed = [k for k in MANIFEST_KEYS if manifest.get(k) != settings.get(k)]
+    if changed:
+        raise ValueError(f'{manifest_file} was written with different settings ({", ".join(changed)}), use another output_path')
+    manifest['shards'] = {k : v for k, v in manifest['shards'].items() if (Path(path) / shard_name(int(k))).exists()}
+    return manifest
+
+def shards(sentences, shard_size):
+    it = iter(sentences)
+    for i in itertools.count():
+        shard = list(itertools.islice(it, shard_size))
+        if not shard:
+            return
+        yield i, shard
+
+def resolve_corpus(resolver, sentences, output_path, settings, generator=None):
+    # Resolves (file, sentence_id, sentence) tuples in shards of settings['shard_size'] sentences, every shard is
+    # written as <output_path>/shard-<i>.tsv and recorded in the manifest once it is complete
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(output_path, settings)
+    if manifest['shards']:
+        log.info(f'Resuming: {len(manifest["shards"])} shards already completed')
+
+    n_sentences = 0
+    for i, shard in shards(sentences, settings['shard_size']):
+        if str(i) in manifest['shards']:
+            continue
+        start = time.perf_counter()
+        if generator is not None:
+            generator.stats.reset()
+        df = pd.DataFrame(shard, columns=['file', 'sentence_id', 'raw_sentence'])
+        df['resolution'] = resolver(df.raw_sentence.tolist())
+        _write_atomic(output_path / shard_name(i), lambda tmp: df.to_csv(tmp, sep='\t', index=False))
+
+        seconds = time.perf_counter() - start
+        manifest['shards'][str(i)] = {
+            'file' : shard_name(i),
+            'n_sentences' : len(df),
+            'n_changed' : int((df.raw_sentence != df.resolution).sum()),
+            'first' : [df.file.iloc[0], int(df.sentence_id.iloc[0])],
+            'seconds' : seconds,
+            'cache_hits' : generator.stats.cache_hits if generator is not None else None,
+        }
+        write_manifest(output_path, manifest)
+        n_sentences += len(df)
+        log.info(f'{shard_name(i)}: {len(df)} sentences in {seconds:.1f}s ({len(df) / seconds:.1f} sentences/s)')
+
+    manifest['complete'] = True
+    manifest['n_sentences'] = sum(s['n_sentences'] for s in manifest['shards'].values())
+    write_manifest(output_path, manifest)
+    log.info(f'Resolved {n_sentences} sentences, {manifest["n_sentences"]} in total')
+    return manifest
+
+def read_resolved(output_path):
+    manifest_file = Path(output_path) / MANIFEST
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    files = [manifest['shards'][k]['file'] for k in sorted(manifest['shards'], key=int)]
+    return pd.concat([pd.read_csv(Path(output_path) / f, sep='\t', keep_default_na=False) for f in files], ignore_index=True)
+
+@hydra.main(config_path='..', config_name='experiment.yaml', version_base="1.2")
+def main(config: DictConfig):
+    corpus_config = config.corpus_resolution
+    log.info(OmegaConf.to_yaml(corpus_config))
+    if not corpus_config.get('checkpoint'):
+        raise ValueError('corpus_resolution.checkpoint is not set, pass corpus_resolution.checkpoint=<path to checkpoint or int8 export>')
+    settings = {
+        'input_path' : to_absolute_path(corpus_config.input_path),
+        'tokens' : corpus_config.get('tokens', False),
+        'shard_size' : corpus_config.get('shard_size', 10000),
+        'checkpoint' : to_absolute_path(corpus_config.checkpoint),
+        'memory_path' : to_absolute_path(corpus_config.memory_path) if corpus_config.get('memory_path') else None,
+    }
+    generator, resolver = get_resolver(config, settings['checkpoint'], settings['memory_path'])
+    sentences = read_corpus_sentences(settings['input_path'], tokens=settings['tokens'])
+    resolve_corpus(resolver, sentences, to_absolute_path(corpus_config.output_path), settings, generator)
+
+if __name__ == "__main__":
+    main()
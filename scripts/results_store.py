@@ -0,0 +1,104 @@
+import os
+import shutil
+import uuid
+from pathlib import Path
+from urllib.parse import quote
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+ERROR_TYPES = ['tp', 'tn', 'fp', 'fn', 'insert', 'delete', 'replace', 'complex']
+CORRECT_TYPES = ['tp', 'tn']
+PARTITION_COLUMNS = ['run', 'split', 'system']
+KEY_COLUMNS = ['file', 'sentence_id', 'occurrence']
+
+def run_key(run_name, sweep_name):
+    # Hydra's multirun job directories (0_learning_rate=...) repeat across sweeps, runs are keyed with the sweep (or date) directory as well
+    return f'{Path(sweep_name).name}/{run_name}'
+
+# Partitioned Parquet store for error analysis results: <path>/run=<run>/split=<split>/system=<system>/*.parquet
+class ResultsStore:
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _partition_path(self, run, split, system):
+        return self.path / f'run={quote(str(run), safe="")}' / f'split={quote(str(split), safe="")}' / f'system={quote(str(system), safe="")}'
+
+    @staticmethod
+    def _normalise(errors):
+        df = pd.DataFrame({
+            'row' : range(len(errors)),
+            'file' : errors['file'].astype(str).values if 'file' in errors else None,
+            'sentence_id' : errors['sentence_id'].astype(str).values if 'sentence_id' in errors else None,
+            'original' : errors['original'].values,
+            'ground_truth' : errors['ground_truth'].values,
+            'pred' : errors['pred'].values,
+            'error_type' : pd.Categorical(errors['error_type'].values, categories=ERROR_TYPES),
+        })
+        if df['file'].isna().all():
+            # Without sentence identifiers, fall back to the position in the split
+            df['file'] = ''
+            df['sentence_id'] = df['row'].astype(str)
+        df['occurrence'] = df.groupby(['file', 'sentence_id']).cumcount()
+        return df
+
+    def write(self, errors, run, split, system='seq2seq'):
+        target = self._partition_path(run, split, system)
+        tmp = target.parent / f'.{target.name}.{uuid.uuid4().hex}'
+        tmp.mkdir(parents=True)
+        self._normalise(errors).to_parquet(tmp / 'part-0.parquet', index=False)
+        # Replace an existing partition as a whole so that readers never see a mix of old and new files
+        if target.exists():
+            old = target.parent / f'.{target.name}.old.{uuid.uuid4().hex}'
+            os.replace(target, old)
+            os.replace(tmp, target)
+            shutil.rmtree(old)
+        else:
+            os.replace(tmp, target)
+        return target
+
+    def read(self, run=None, split=None, system=None, columns=None):
+        filters = [(c, '=', str(v)) for c, v in zip(PARTITION_COLUMNS, [run, split, system]) if v is not None]
+        partitioning = ds.partitioning(pa.schema([(c, pa.string()) for c in PARTITION_COLUMNS]), flavor='hive')
+        df = pd.read_parquet(self.path, engine='pyarrow', filters=filters or None, columns=columns, partitioning=partitioning)
+        for c in PARTITION_COLUMNS:
+            if c in df:
+                df[c] = df[c].astype(str)
+        if 'error_type' in df:
+            df['error_type'] = pd.Categorical(df['error_type'].astype(str), categories=ERROR_TYPES)
+        return df
+
+    def partitions(self):
+        df = self.read(columns=PARTITION_COLUMNS)
+        return df.drop_duplicates().sort_values(PARTITION_COLUMNS).reset_index(drop=True)
+
+    def compare(self, run_a, run_b, split, system_a='seq2seq', system_b=None):
+        columns = KEY_COLUMNS + ['row', 'original', 'ground_truth', 'pred', 'error_type']
+        a = self.read(run_a, split, system_a, columns=columns)
+        b = self.read(run_b, split, system_b or system_a, columns=columns)
+        if len(a) == 0 or len(b) == 0:
+            raise ValueError(f'No results for {(run_a, split, system_a)} or {(run_b, split, system_b or system_a)}')
+
+        df = a.merge(b[KEY_COLUMNS + ['pred', 'error_type']], on=KEY_COLUMNS, suffixes=('_a', '_b'), how='inner')
+        correct_a = df.error_type_a.isin(CORRECT_TYPES)
+        correct_b = df.error_type_b.isin(CORRECT_TYPES)
+        df['change'] = 'same'
+        df.loc[df.pred_a != df.pred_b, 'change'] = 'changed'
+        df.loc[correct_a & ~correct_b, 'change'] = 'regression'
+        df.loc[~correct_a & correct_b, 'change'] = 'improvement'
+        return df.sort_values('row').reset_index(drop=True)
+
+    def flips(self, run_a, run_b, split, system_a='seq2seq', system_b=None):
+        df = self.compare(run_a, run_b, split, system_a, system_b)
+        return pd.crosstab(df.error_type_a, df.error_type_b, dropna=False)
+
+    def regressions(self, run_a, run_b, split, system_a='seq2seq', system_b=None):
+        df = self.compare(run_a, run_b, split, system_a, system_b)
+        return df[df.change == 'regression']
+
+    def transitions(self, run_a, run_b, split, from_type, to_type, system_a='seq2seq', system_b=None):
+        df = self.compare(run_a, run_b, split, system_a, system_b)
+        return df[(df.error_type_a == from_type) & (df.error_type_b == to_type)]
@@ -0,0 +1,150 @@
+import hydra
+from omegaconf import DictConfig, OmegaConf
+from hydra.core.hydra_config import HydraConfig
+from hydra.utils import to_absolute_path
+
+import transformers
+from transformers import AutoTokenizer
+import logging
+import os
+import wandb
+import pandas as pd
+from pathlib import Path
+
+from dataset import load_data, read_corpus_sentences, EllipsesDataset
+from transformers_util import get_training_args, get_distillation_trainer, get_tokenizer
+from evaluation import error_analysis, get_scores, encode_decode
+from cache_util import NormalisationCache, GenerationCache
+from results_store import ResultsStore, run_key
+from inference import BatchedGenerator
+from quantize import load_model
+from distillation import get_distillation_data
+from trim_vocab import load_vocab_mapping
+
+log = logging.getLogger(__name__)
+
+def run(config, run_name, sweep_name):
+    log.info(f'Fixing random seed {config.random_seed}')
+    transformers.trainer_utils.set_seed(config.random_seed)
+
+    transformers.logging.disable_default_handler()
+
+    log.info(OmegaConf.to_yaml(config))
+    log.info('Running in: ' + os.getcwd())
+
+    distillation_config = config.distillation
+
+    with wandb.init(project=config.wandb_project, name=run_name, reinit=True) as run:
+
+        wandb.log(OmegaConf.to_container(config))
+        wandb.log({'hydra_sweep' : sweep_name})
+        wandb.log({'experiment_dir': os.getcwd()})
+
+        training_args = get_training_args(OmegaConf.merge(config, distillation_config), report_to="wandb")
+        tokenizer = get_tokenizer(config)
+        if os.path.isdir(to_absolute_path(distillation_config.student_model_name)):
+            distillation_config.student_model_name = to_absolute_path(distillation_config.student_model_name)
+        # Students with a trimmed vocabulary (trim_vocab.py) come with their own tokenizer
+        vocab_mapping = load_vocab_mapping(distillation_config.student_model_name) if os.path.isdir(distillation_config.student_model_name) else None
+        student_tokenizer = AutoTokenizer.from_pretrained(distillation_config.student_model_name) if vocab_mapping else tokenizer
+
+        train_df, val_df, test_df = load_data(
+            to_absolute_path(config.data.cnf_tsv_path),
+            to_absolute_path(config.data.controls_tsv_path) if config.data.controls_tsv_path else None,
+            sample_frac=config.get("sample", None))
+
+        cache_dir = Path(to_absolute_path(config.data.cache_dir)) if config.data.get('cache_dir') else None
+        norm_cache = NormalisationCache(cache_dir / 'normalisation.sqlite') if cache_dir else None
+        generation_cache = GenerationCache(cache_dir / 'generation.sqlite') if cache_dir and config.inference.get('cache') else None
+
+        teacher_checkpoint = to_absolute_path(distillation_config.teacher_checkpoint)
+        log.info(f'Loading teacher {teacher_checkpoint}')
+        teacher = load_model(teacher_checkpoint)
+        teacher_generator = BatchedGenerator.from_config(teacher, tokenizer, config, cache=generation_cache)
+
+        corpus_sentences = read_corpus_sentences(to_absolute_path(distillation_config.corpus_path), tokens=distillation_config.get('corpus_tokens', False)) \
+            if distillation_config.get('corpus_path') else []
+
+        log.info('Generating teacher targets')
+        distill_df = get_distillation_data(train_df, corpus_sentences, teacher_generator,
+            use_gold=distillation_config.get('use_gold', True),
+            seed=config.random_seed,
+            max_corpus_sentences=distillation_config.get('max_corpus_sentences'),
+            exclude=pd.concat([val_df.raw_sentence, test_df.raw_sentence]))
+        wandb.log(teacher_generator.stats.report('distillation/teacher_inference'))
+        wandb.log({f'n_distillation_{source}' : n for source, n in distill_df.source.value_counts().items()})
+
+        train_dataset = EllipsesDataset(distill_df.raw_sentence, distill_df.full_resolution, student_tokenizer)
+        val_dataset = EllipsesDataset(val_df.raw_sentence, val_df.full_resolution, student_tokenizer)
+
+        trainer = get_distillation_trainer(config, student_tokenizer, training_args, teacher, train_dataset, val_dataset, vocab_mapping=vocab_mapping)
+
+        trainer.train()
+
+        wandb.log({'best_cp' : trainer.state.best_model_checkpoint})
+
+        # Evaluation without the generation cache, so that the inference timings of both models cover every sentence
+        student_generator = BatchedGenerator.from_config(trainer.model, student_tokenizer, config)
+        teacher_generator = BatchedGenerator.from_config(teacher, tokenizer, config)
+
+        def get_errors(sample, key):
+            references = encode_decode(sample.full_resolution, tokenizer, norm_cache)
+            originals = encode_decode(sample.raw_sentence, tokenizer, norm_cache)
+
+            student_generator.stats.reset()
+            teacher_generator.stats.reset()
+            gen = student_generator(sample.raw_sentence)
+            teacher_gen = teacher_generator(sample.raw_sentence)
+            student_stats = student_generator.stats.report(f'{key}/inference')
+            teacher_stats = teacher_generator.stats.report(f'{key}/teacher_inference')
+            wandb.log(student_stats)
+            wandb.log(teacher_stats)
+            if f'{key}/inference/sentences_per_s' in student_stats and f'{key}/teacher_inference/sentences_per_s' in teacher_stats:
+                wandb.log({f'{key}/speedup' : student_stats[f'{key}/inference/sentences_per_s'] / teacher_stats[f'{key}/teacher_inference/sentences_per_s']})
+
+            errors = error_analysis(gen, references, originals)
+            errors = pd.concat([errors, sample[['file', 'sentence_id']].reset_index(drop=True)], axis=1)
+            teacher_errors = error_analysis(teacher_gen, references, originals)
+            # Fidelity: the teacher outputs as references
+            wandb.log(get_scores(error_analysis(gen, teacher_gen, originals), f'{key}/vs_teacher'))
+            return errors, teacher_errors
+
+        log.info("Running error analysis on dev set")
+        errors_valid, teacher_errors_valid = get_errors(val_df, "eval")
+        valid_scores = get_scores(errors_valid, "eval")
+        wandb.log(valid_scores)
+        wandb.log(get_scores(teacher_errors_valid, "eval/teacher"))
+
+        log.info("Running error analysis on test set")
+        errors_test, teacher_errors_test = get_errors(test_df, "test")
+        test_scores = get_scores(errors_test, "test")
+        wandb.log(test_scores)
+        wandb.log(get_scores(teacher_errors_test, "test/teacher"))
+
+        if config.get('results_store_path'):
+            results_store = ResultsStore(to_absolute_path(config.results_store_path))
+            results_store.write(errors_valid, run_key(run_name, sweep_name), 'dev', 'distilled')
+            results_store.write(errors_test, run_key(run_name, sweep_name), 'test', 'distilled')
+            wandb.log({'results_store' : str(results_store.path), 'results_store_run' : run_key(run_name, sweep_name)})
+
+        return valid_scores['eval/exact_match']
+
+
+@hydra.main(config_path='..', config_name='experiment.yaml', version_base="1.2")
+def main(config: DictConfig):
+    hydra_conf = HydraConfig.get()
+
+    run_name = Path(os.getcwd()).name
+
+    if 'id' in hydra_conf.job:
+        sweep_name = hydra_conf.sweep.dir
+        log.info("Running in a parameter sweep")
+    else:
+        sweep_name = config.date_run
+
+    log.info(f"Grouping by {sweep_name}")
+
+    return run(config, run_name, sweep_name)
+
+if __name__ == "__main__":
+    main()
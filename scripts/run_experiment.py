@@ -4,20 +4,32 @@ from hydra.core.hydra_config import HydraConfig
 from hydra.utils import to_absolute_path
 
 import transformers
-from transformers import Text2TextGenerationPipeline
+from transformers import AutoModelForSeq2SeqLM
 import logging
 import os
 import sys
 import wandb
+import pandas as pd
 from pathlib import Path
 
 from dataset import load_data, get_dataloader
 from transformers_util import get_training_args, get_trainer, get_tokenizer
 from evaluation import error_analysis, get_scores, encode_decode
+from cache_util import NormalisationCache, GenerationCache
+from results_store import ResultsStore, run_key
+from inference import BatchedGenerator
+from span_resolution import SpanResolver
+from resolution_memory import ResolutionMemory, MemoryResolver
+from pruning import get_pruning_callback
+from sweep_cache import SWEEP_CACHE
+from checkpoint_evaluator import CheckpointEvaluator, BackgroundEvaluationCallback
+from distributed import launch, is_main_process, world_size, ThroughputCallback
+from control_sampling import AdaptiveControlSampler, IndexedDataset
+from profiling import PhaseProfiler, PhaseCallback
 
 log = logging.getLogger(__name__)
 
-def run(config, run_name, sweep_name):
+def run(config, run_name, sweep_name, cache=None):
     log.info(f'Fixing random seed {config.random_seed}')
     transformers.trainer_utils.set_seed(config.random_seed)
     
@@ -26,19 +38,34 @@ def run(config, run_name, sweep_name):
     log.info(OmegaConf.to_yaml(config))
     log.info('Running in: ' + os.getcwd())
 
-    with wandb.init(project=config.wandb_project, name=run_name, reinit=True) as run:
+    # Distributed training: only rank 0 logs to wandb and runs the error analysis
+    main_process = is_main_process()
+
+    # Phase timings are logged to wandb and written to profile.json when the run ends, also for pruned trials
+    with wandb.init(project=config.wandb_project, name=run_name, reinit=True, mode=None if main_process else 'disabled') as run, \
+        PhaseProfiler.from_config(config, log_fn=wandb.log, enabled=main_process and config.get('profiling', {}).get('enabled', True)) as profiler:
 
         wandb.log(OmegaConf.to_container(config))
         wandb.log({'hydra_sweep' : sweep_name})
         wandb.log({'experiment_dir': os.getcwd()})
 
-        training_args = get_training_args(config, report_to="wandb")
-        tokenizer = get_tokenizer(config)
+        background_evaluation = config.get('checkpoint_eval', {}).get('enabled', False)
+        if background_evaluation and world_size() > 1:
+            raise ValueError('checkpoint_eval is not supported with distributed.num_processes > 1')
+        training_args = get_training_args(config, report_to="wandb" if main_process else "none", background_evaluation=background_evaluation)
+
+        def cached(name, key, load_fn):
+            return cache.get(name, key, load_fn) if cache else load_fn()
+
+        with profiler.phase('tokenizer'):
+            tokenizer = cached('tokenizer', config.model_name, lambda: get_tokenizer(config))
 
-        train_df, val_df, test_df = load_data(
-            to_absolute_path(config.data.cnf_tsv_path), 
-            to_absolute_path(config.data.controls_tsv_path) if config.data.controls_tsv_path else None,
-            sample_frac=config.get("sample", None))
+        data_key = (config.data.cnf_tsv_path, config.data.controls_tsv_path, config.get("sample", None), config.random_seed)
+        with profiler.phase('data'):
+            train_df, val_df, test_df = cached('data', data_key, lambda: load_data(
+                to_absolute_path(config.data.cnf_tsv_path), 
+                to_absolute_path(config.data.controls_tsv_path) if config.data.controls_tsv_path else None,
+                sample_frac=config.get("sample", None)))
 
         wandb.log({"n_ellipses_train": (~train_df.controls).sum()})
         wandb.log({"n_ellipses_dev": (~val_df.controls).sum()})
@@ -48,32 +75,120 @@ def run(config, run_name, sweep_name):
         wandb.log({"n_controls_dev" : val_df.controls.sum()})
         wandb.log({"n_controls_test" : test_df.controls.sum()})
 
-        train_dataset, val_dataset, test_dataset = get_dataloader(train_df, val_df, test_df, tokenizer)
-
-        trainer = get_trainer(config, tokenizer, training_args, train_dataset, val_dataset)
-
-        trainer.train()
+        with profiler.phase('tokenization'):
+            train_dataset, val_dataset, test_dataset = cached('datasets', (config.model_name, ) + data_key,
+                lambda: get_dataloader(train_df, val_df, test_df, tokenizer))
+
+        # Epoch-wise subsampling of the control sentences by their training loss
+        control_sampler = None
+        if config.get('control_sampling', {}).get('enabled', False):
+            if world_size() > 1:
+                raise ValueError('control_sampling is not supported with distributed.num_processes > 1')
+            control_sampler = AdaptiveControlSampler.from_config(train_df.controls.values, config)
+            train_dataset = IndexedDataset(train_dataset)
+
+        cache_dir = Path(to_absolute_path(config.data.cache_dir)) if config.data.get('cache_dir') else None
+
+        evaluator, evaluation_callback = None, None
+        if background_evaluation:
+            evaluator = CheckpointEvaluator(config, val_df,
+                keep_best_only=config.checkpoint_eval.get('keep_best_only', True),
+                norm_cache_path=cache_dir / 'normalisation.sqlite' if cache_dir else None)
+            evaluation_callback = BackgroundEvaluationCallback(evaluator)
+
+        # All ranks have to stop together, pruning is only supported in single-process training
+        pruning_callback = get_pruning_callback(config, training_args) if world_size() == 1 else None
+        throughput_callback = ThroughputCallback(len(train_dataset), control_sampler)
+        with profiler.phase('model_load'):
+            trainer = get_trainer(config, tokenizer, training_args, train_dataset, val_dataset,
+                callbacks=[c for c in [pruning_callback, evaluation_callback, throughput_callback, PhaseCallback(profiler)] if c],
+                model=cache.model(config.model_name) if cache else None,
+                control_sampler=control_sampler)
+        if evaluation_callback:
+            evaluation_callback.trainer = trainer
+        if cache:
+            wandb.log(cache.report())
+
+        with profiler.phase('train'):
+            trainer.train()
+        wandb.log(throughput_callback.report)
+        if control_sampler:
+            wandb.log(control_sampler.report())
+
+        if evaluator and evaluator.best:
+            log.info(f'Loading best checkpoint {evaluator.best}')
+            with profiler.phase('load_best'):
+                trainer.model.load_state_dict(AutoModelForSeq2SeqLM.from_pretrained(evaluator.best).state_dict())
         
         wandb.log({'best_cp' : trainer.state.best_model_checkpoint})
 
-        pipeline = Text2TextGenerationPipeline(model=trainer.model, tokenizer=tokenizer, max_length=config.generation_max_length, device=0)
-
-        def get_errors(sample):
-            out = pipeline(list(sample.raw_sentence))
-            gen = [o['generated_text'] for o in out]
-            errors = error_analysis(gen, encode_decode(sample.full_resolution, tokenizer), encode_decode(sample.raw_sentence, tokenizer))
+        # Raising TrialPruned would be recorded as a failed trial by the sweeper. Pruned trials return the generated dev
+        # exact match of their best checkpoint instead, on the same scale as complete trials, and skip the test set
+        pruned = pruning_callback is not None and pruning_callback.pruned
+        wandb.log({'pruned' : pruned})
+
+        if not main_process:
+            return None
+
+        norm_cache = NormalisationCache(cache_dir / 'normalisation.sqlite') if cache_dir else None
+        generation_cache = GenerationCache(cache_dir / 'generation.sqlite') if cache_dir and config.inference.get('cache') else None
+
+        generator = BatchedGenerator.from_config(trainer.model, tokenizer, config, cache=generation_cache)
+        span_resolver = SpanResolver.from_config(generator, config) if config.inference.get('mode') == 'span' else None
+        resolver = span_resolver or generator
+
+        memory_resolver = None
+        if config.inference.get('memory'):
+            memory = ResolutionMemory.from_pairs(train_df.raw_sentence, train_df.full_resolution, config.inference.get('memory_min_count', 1))
+            memory.save('resolution_memory.json')
+            resolver = memory_resolver = MemoryResolver(memory, resolver)
+
+        def get_errors(sample, key):
+            generator.stats.reset()
+            with profiler.phase(f'{key}/generation'):
+                gen = resolver(sample.raw_sentence)
+            wandb.log(generator.stats.report(f'{key}/inference'))
+            if span_resolver:
+                wandb.log(span_resolver.report(f'{key}/span'))
+                span_resolver.reset_stats()
+            if memory_resolver:
+                wandb.log(memory_resolver.report(f'{key}/memory'))
+                memory_resolver.reset_stats()
+            with profiler.phase(f'{key}/encode_decode'):
+                if span_resolver or memory_resolver:
+                    # Text that is not decoded by the model, normalise it like the references
+                    gen = encode_decode(gen, tokenizer)
+                references, originals = encode_decode(sample.full_resolution, tokenizer, norm_cache), encode_decode(sample.raw_sentence, tokenizer, norm_cache)
+            with profiler.phase(f'{key}/error_analysis'):
+                errors = error_analysis(gen, references, originals)
+            errors = pd.concat([errors, sample[['file', 'sentence_id']].reset_index(drop=True)], axis=1)
             return errors
 
+        results_store = ResultsStore(to_absolute_path(config.results_store_path)) if config.get('results_store_path') else None
+
         log.info("Running error analysis on dev set")
-        errors_valid = get_errors(val_df)               
+        if evaluator and evaluator.best and not memory_resolver:
+            # Already generated by the background evaluator
+            errors_valid = evaluator.errors(evaluator.best)
+        else:
+            errors_valid = get_errors(val_df, "eval")               
         valid_scores = get_scores(errors_valid, "eval")
         wandb.log(valid_scores)
 
+        if pruned:
+            return valid_scores['eval/exact_match']
+
         log.info("Running error analysis on test set")
-        errors_test = get_errors(test_df)               
+        errors_test = get_errors(test_df, "test")               
         test_scores = get_scores(errors_test, "test")
         wandb.log(test_scores)
 
+        if results_store:
+            system = 'seq2seq' + ('_span' if span_resolver else '') + ('_memory' if memory_resolver else '')
+            results_store.write(errors_valid, run_key(run_name, sweep_name), 'dev', system)
+            results_store.write(errors_test, run_key(run_name, sweep_name), 'test', system)
+            wandb.log({'results_store' : str(results_store.path), 'results_store_run' : run_key(run_name, sweep_name)})
+
         return valid_scores['eval/exact_match']
 
 
@@ -92,7 +207,15 @@ def main(config: DictConfig):
         
     log.info(f"Grouping by {sweep_name}")
 
-    metric = run(config, run_name, sweep_name)
+    # Only in sweeps: all trials run in this process
+    cache = SWEEP_CACHE if 'id' in hydra_conf.job and config.get('sweep_cache') else None
+
+    num_processes = config.get('distributed', {}).get('num_processes', 1)
+    if num_processes > 1:
+        metric = launch(run, num_processes, OmegaConf.create(OmegaConf.to_container(config, resolve=True)), run_name, sweep_name,
+            threads_per_process=config.distributed.get('threads_per_process'))
+    else:
+        metric = run(config, run_name, sweep_name, cache)
 
     return metric
     
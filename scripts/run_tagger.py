@@ -0,0 +1,107 @@
+import hydra
+from omegaconf import DictConfig, OmegaConf
+from hydra.core.hydra_config import HydraConfig
+from hydra.utils import to_absolute_path
+
+import transformers
+import logging
+import os
+import time
+import wandb
+import pandas as pd
+from pathlib import Path
+
+from dataset import load_data, get_tagging_dataloader
+from transformers_util import get_training_args, get_tagger_trainer, get_tagger_tokenizer
+from evaluation import error_analysis, get_scores
+from edit_tagging import TagVocabulary, EditTagger
+from results_store import ResultsStore, run_key
+
+log = logging.getLogger(__name__)
+
+def run(config, run_name, sweep_name):
+    log.info(f'Fixing random seed {config.random_seed}')
+    transformers.trainer_utils.set_seed(config.random_seed)
+
+    transformers.logging.disable_default_handler()
+
+    log.info(OmegaConf.to_yaml(config))
+    log.info('Running in: ' + os.getcwd())
+
+    with wandb.init(project=config.wandb_project, name=run_name, reinit=True) as run:
+
+        wandb.log(OmegaConf.to_container(config))
+        wandb.log({'hydra_sweep' : sweep_name})
+        wandb.log({'experiment_dir': os.getcwd()})
+
+        training_args = get_training_args(OmegaConf.merge(config, config.tagger), report_to="wandb")
+        tokenizer = get_tagger_tokenizer(config)
+
+        train_df, val_df, test_df = load_data(
+            to_absolute_path(config.data.cnf_tsv_path),
+            to_absolute_path(config.data.controls_tsv_path) if config.data.controls_tsv_path else None,
+            sample_frac=config.get("sample", None))
+
+        vocab = TagVocabulary.build(train_df.raw_sentence, train_df.full_resolution, config.tagger.min_tag_count)
+        vocab.save('tag_vocabulary.json')
+        wandb.log({'n_tags' : len(vocab)})
+        wandb.log({'tag_coverage_train' : vocab.coverage(train_df.raw_sentence, train_df.full_resolution)})
+        wandb.log({'tag_coverage_dev' : vocab.coverage(val_df.raw_sentence, val_df.full_resolution)})
+
+        train_dataset, val_dataset, test_dataset = get_tagging_dataloader(train_df, val_df, test_df, tokenizer, vocab)
+
+        trainer = get_tagger_trainer(config, tokenizer, training_args, train_dataset, val_dataset, vocab)
+
+        trainer.train()
+
+        wandb.log({'best_cp' : trainer.state.best_model_checkpoint})
+
+        tagger = EditTagger(trainer.model, tokenizer, vocab, device=config.inference.get('device', 'auto'), batch_size=config.tagger.eval_batch_size)
+
+        def get_errors(sample, key):
+            start = time.perf_counter()
+            pred = tagger(sample.raw_sentence)
+            seconds = time.perf_counter() - start
+            wandb.log({f'{key}/inference/seconds' : seconds, f'{key}/inference/sentences_per_s' : len(sample) / seconds})
+            # The tagger edits the raw text directly, so there is no tokenizer normalisation to apply to the references
+            errors = error_analysis(pred, sample.full_resolution.tolist(), sample.raw_sentence.tolist())
+            errors = pd.concat([errors, sample[['file', 'sentence_id']].reset_index(drop=True)], axis=1)
+            return errors
+
+        log.info("Running error analysis on dev set")
+        errors_valid = get_errors(val_df, "eval")
+        valid_scores = get_scores(errors_valid, "eval")
+        wandb.log(valid_scores)
+
+        log.info("Running error analysis on test set")
+        errors_test = get_errors(test_df, "test")
+        test_scores = get_scores(errors_test, "test")
+        wandb.log(test_scores)
+
+        if config.get('results_store_path'):
+            results_store = ResultsStore(to_absolute_path(config.results_store_path))
+            results_store.write(errors_valid, run_key(run_name, sweep_name), 'dev', 'tagger')
+            results_store.write(errors_test, run_key(run_name, sweep_name), 'test', 'tagger')
+            wandb.log({'results_store' : str(results_store.path), 'results_store_run' : run_key(run_name, sweep_name)})
+
+        return valid_scores['eval/exact_match']
+
+
+@hydra.main(config_path='..', config_name='experiment.yaml', version_base="1.2")
+def main(config: DictConfig):
+    hydra_conf = HydraConfig.get()
+
+    run_name = Path(os.getcwd()).name
+
+    if 'id' in hydra_conf.job:
+        sweep_name = hydra_conf.sweep.dir
+        log.info("Running in a parameter sweep")
+    else:
+        sweep_name = config.date_run
+
+    log.info(f"Grouping by {sweep_name}")
+
+    return run(config, run_name, sweep_name)
+
+if __name__ == "__main__":
+    main()
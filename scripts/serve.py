@@ -0,0 +1,196 @@
+import hydra
+from omegaconf import DictConfig, OmegaConf
+from hydra.utils import to_absolute_path
+
+import asyncio
+import logging
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from aiohttp import web
+
+from cache_util import GenerationCache
+from inference import BatchedGenerator
+from quantize import load_model, is_quantized
+from resolution_memory import ResolutionMemory, MemoryResolver
+from span_resolution import SpanResolver
+from transformers_util import get_tokenizer
+
+log = logging.getLogger(__name__)
+
+class ServerStats:
+
+    def __init__(self, window=10000):
+        # Latencies of the last `window` sentences
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = Counter()
+        self.n_requests = 0
+        self.n_sentences = 0
+        self.n_errors = 0
+        self.cache_hits = 0
+        self.started = time.time()
+
+    def report(self, queue_depth):
+        latencies = np.array(self.latencies) * 1000
+        return {
+            'uptime_s' : time.time() - self.started,
+            'queue_depth' : queue_depth,
+            'n_requests' : self.n_requests,
+            'n_sentences' : self.n_sentences,
+            'n_batches' : sum(self.batch_sizes.values()),
+            'n_errors' : self.n_errors,
+            'cache_hits' : self.cache_hits,
+            'batch_size_histogram' : {str(k) : v for k, v in sorted(self.batch_sizes.items())},
+            'latency_p50_ms' : float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'latency_p99_ms' : float(np.percentile(latencies, 99)) if len(latencies) else None,
+        }
+
+# Coalesces sentences from concurrent requests into batches: a batch is started as soon as max_batch_size
+# sentences are queued or max_wait_ms after its first sentence arrived. The model runs in a single worker thread,
+# so the event loop keeps accepting requests (which form the next batch) while a batch is generated
+class MicroBatcher:
+
+    def __init__(self, generate_fn, max_batch_size=32, max_wait_ms=10, stats=None):
+        self.generate_fn = generate_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = stats or ServerStats()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self._task = None
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown(wait=True)
+
+    async def resolve(self, sentences):
+        loop = asyncio.get_running_loop()
+        futures = []
+        for sentence in sentences:
+            future = loop.create_future()
+            self.queue.put_nowait((sentence, future, time.perf_counter()))
+            futures.append(future)
+        self.stats.n_requests += 1
+        return await asyncio.gather(*futures)
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            # Requests that were cancelled by the client while waiting are not generated
+            batch = [item for item in batch if not item[1].cancelled()]
+            if not batch:
+                continue
+            try:
+                outputs = await loop.run_in_executor(self.executor, self.generate_fn, [s for s, _, _ in batch])
+            except Exception as e:
+                log.exception('Generation failed')
+                self.stats.n_errors += 1
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            now = time.perf_counter()
+            self.stats.batch_sizes[len(batch)] += 1
+            self.stats.n_sentences += len(batch)
+            for (_, future, received), output in zip(batch, outputs):
+                self.stats.latencies.append(now - received)
+                if not future.done():
+                    future.set_result(output)
+
+def create_app(batcher, max_sentences=256):
+
+    async def resolve(request):
+        try:
+            body = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text='Expected a JSON body')
+        if not isinstance(body, dict):
+            raise web.HTTPBadRequest(text='Expected {"sentence": str} or {"sentences": [str, ...]}')
+        single = 'sentence' in body
+        sentences = [body['sentence']] if single else body.get('sentences')
+        if not isinstance(sentences, list) or not all(isinstance(s, str) for s in sentences):
+            raise web.HTTPBadRequest(text='Expected {"sentence": str} or {"sentences": [str, ...]}')
+        if len(sentences) > max_sentences:
+            raise web.HTTPRequestEntityTooLarge(max_size=max_sentences, actual_size=len(sentences))
+        resolutions = await batcher.resolve(sentences)
+        return web.json_response({'resolution' : resolutions[0]} if single else {'resolutions' : resolutions})
+
+    async def metrics(request):
+        return web.json_response(batcher.stats.report(batcher.queue.qsize()))
+
+    async def on_startup(app):
+        await batcher.start()
+
+    async def on_cleanup(app):
+        await batcher.stop()
+
+    app = web.Application()
+    app.add_routes([web.post('/resolve', resolve), web.get('/metrics', metrics)])
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+def get_resolver(config, checkpoint, memory_path=None):
+    checkpoint = to_absolute_path(checkpoint)
+    log.info(f'Loading {checkpoint}')
+    model = load_model(checkpoint)
+    tokenizer = get_tokenizer(config)
+
+    cache_dir = Path(to_absolute_path(config.data.cache_dir)) if config.data.get('cache_dir') else None
+    generation_cache = GenerationCache(cache_dir / 'generation.sqlite') if cache_dir and config.inference.get('cache') else None
+    kwargs = {'device' : 'cpu'} if is_quantized(checkpoint) else {}
+    generator = BatchedGenerator.from_config(model, tokenizer, config, cache=generation_cache, **kwargs)
+    resolver = SpanResolver.from_config(generator, config) if config.inference.get('mode') == 'span' else generator
+    if memory_path:
+        resolver = MemoryResolver(ResolutionMemory.load(to_absolute_path(memory_path)), resolver)
+    return generator, resolver
+
+@hydra.main(config_path='..', config_name='experiment.yaml', version_base="1.2")
+def main(config: DictConfig):
+    log.info(OmegaConf.to_yaml(config.serve))
+    if not config.serve.get('checkpoint'):
+        raise ValueError('serve.checkpoint is not set, pass serve.checkpoint=<path to checkpoint or int8 export>')
+    generator, resolver = get_resolver(config, config.serve.checkpoint, config.serve.get('memory_path'))
+    stats = ServerStats()
+
+    def generate(sentences):
+        # Generator stats are per batch, only the cache hits are accumulated
+        generator.stats.reset()
+        res = resolver(sentences)
+        stats.cache_hits += generator.stats.cache_hits
+        return res
+
+    batcher = MicroBatcher(generate, config.serve.max_batch_size, config.serve.max_wait_ms, stats=stats)
+    web.run_app(create_app(batcher, config.serve.max_sentences), host=config.serve.host, port=config.serve.port)
+
+if __name__ == "__main__":
+    main()
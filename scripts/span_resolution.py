@@ -0,0 +1,124 @@
+import re
+
+from edit_tagging import TRAILING_PUNCTUATION, split_words
+
+# Plain-text approximation of the TRUNC patterns in EllipticCompound.findPattern:
+# a word with a suspended hyphen, optionally further TRUNCs separated by commas, a conjunction and the compound
+# (TRUNC $, TRUNC KON NN / TRUNC KON ... NN), or a compound, a conjunction and a word with a leading hyphen (WORD KON -WORD)
+CONJUNCTIONS = {'und', 'oder', 'bzw.', 'sowie', 'bis', 'resp.', 'und/oder', 'oder/und', '/', '&', 'u.', 'od.'}
+HYPHENS = '-–'
+TRUNC_RE = re.compile(rf'\w[{HYPHENS}],?$')
+REVERSED_RE = re.compile(rf'^[{HYPHENS}]\w{{2,}}')
+
+def _end(word):
+    # Trailing punctuation of the last word (Strahlentherapie. / Strahlentherapie,) is not part of a span
+    return word[1] - len(TRAILING_PUNCTUATION.search(word[2]).group())
+
+def find_ellipsis_spans(sentence, max_gap=3):
+    words = split_words(sentence)
+    spans = []
+    i = 0
+    while i < len(words):
+        text = words[i][2]
+        if TRUNC_RE.search(text):
+            # (1), (2): further TRUNCs separated by commas
+            j = i + 1
+            while j < len(words) and TRUNC_RE.search(words[j][2]):
+                j += 1
+            if j < len(words) - 1 and words[j][2] in CONJUNCTIONS:
+                # (4) - (9): up to max_gap words (APPR, ART, ADJA, ...) between the conjunction and the compound
+                candidates = words[j + 1:j + 2 + max_gap]
+                head = next((k for k, w in enumerate(candidates) if w[2][:1].isupper()), 0)
+                end = j + 1 + head
+                spans.append((words[i][0], _end(words[end])))
+                i = end + 1
+                continue
+            elif j < len(words) and j > i + 1:
+                # TRUNC $, TRUNC followed by a compound without conjunction
+                spans.append((words[i][0], _end(words[j])))
+                i = j + 1
+                continue
+        elif REVERSED_RE.match(text) and i >= 2 and words[i - 1][2] in CONJUNCTIONS:
+            # (11) WORD KON -WORD
+            start = words[i - 2][0]
+            if spans and spans[-1][1] >= start:
+                spans[-1] = (spans[-1][0], _end(words[i]))
+            else:
+                spans.append((start, _end(words[i])))
+        i += 1
+    return spans
+
+def context_windows(sentence, spans, window=3):
+    # Extends each span by `window` words on both sides and merges overlapping or adjacent windows
+    words = split_words(sentence)
+    starts = [w[0] for w in words]
+    ends = [w[1] for w in words]
+    ranges = []
+    for span_start, span_end in spans:
+        first = max(0, starts.index(span_start) - window)
+        last = min(len(words) - 1, next(k for k, end in enumerate(ends) if end >= span_end) + window)
+        if ranges and first <= ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], max(last, ranges[-1][1]))
+        else:
+            ranges.append((first, last))
+    return [(starts[first], ends[last]) for first, last in ranges]
+
+def splice(sentence, windows, rewrites):
+    res = []
+    last = 0
+    for (start, end), rewrite in zip(windows, rewrites):
+        res.append(sentence[last:start])
+        res.append(rewrite if rewrite.strip() else sentence[start:end])
+        last = end
+    res.append(sentence[last:])
+    return ''.join(res)
+
+# Resolves only bounded context windows around candidate ellipses and splices the rewrites back into the sentence,
+# sentences without candidates are returned unchanged without calling the model
+class SpanResolver:
+
+    def __init__(self, generate_fn, window=3, max_gap=3):
+        self.generate_fn = generate_fn
+        self.window = window
+        self.max_gap = max_gap
+        self.reset_stats()
+
+    @classmethod
+    def from_config(cls, generate_fn, config):
+        inference_config = config.get('inference', {})
+        return cls(generate_fn, window=inference_config.get('span_window', 3))
+
+    def reset_stats(self):
+        self.n_sentences = 0
+        self.n_skipped = 0
+        self.n_windows = 0
+        self.window_chars = 0
+        self.sentence_chars = 0
+
+    def report(self, key='span'):
+        return {
+            f'{key}/n_sentences' : self.n_sentences,
+            f'{key}/n_without_candidates' : self.n_skipped,
+            f'{key}/n_windows' : self.n_windows,
+            f'{key}/window_char_ratio' : self.window_chars / self.sentence_chars if self.sentence_chars else 0.0,
+        }
+
+    def __call__(self, sentences):
+        sentences = list(sentences)
+        windows = [context_windows(s, find_ellipsis_spans(s, self.max_gap), self.window) for s in sentences]
+        fragments = [s[start:end] for s, ws in zip(sentences, windows) for start, end in ws]
+
+        rewrites = self.generate_fn(fragments) if fragments else []
+
+        self.n_sentences += len(sentences)
+        self.n_skipped += sum(1 for ws in windows if not ws)
+        self.n_windows += len(fragments)
+        self.window_chars += sum(len(f) for f in fragments)
+        self.sentence_chars += sum(len(s) for s in sentences)
+
+        res = []
+        offset = 0
+        for s, ws in zip(sentences, windows):
+            res.append(splice(s, ws, rewrites[offset:offset + len(ws)]))
+            offset += len(ws)
+        return res
@@ -0,0 +1,73 @@
+import torch
+
+# Greedy decoding with the source sentence as draft (prompt lookup decoding):
+# resolutions mostly copy the input, so spans following the current suffix in the source
+# are proposed and verified in a single decoder forward pass. Accepted tokens are exactly
+# the greedy predictions, so the output is the same as greedy generate().
+
+def _crop_cache(past_key_values, length):
+    if hasattr(past_key_values, 'crop'):
+        past_key_values.crop(length)
+        return past_key_values
+    # Legacy format: per layer (self_k, self_v, cross_k, cross_v) with shape (batch, heads, seq, dim)
+    return tuple((layer[0][:, :, :length], layer[1][:, :, :length]) + tuple(layer[2:]) for layer in past_key_values)
+
+def propose_draft(source, generated, pointer, max_ngram=3, num_draft=16):
+    # Returns the draft tokens and the source position the draft starts at
+    if not generated:
+        return source[:num_draft], 0
+    for n in range(min(max_ngram, len(generated)), 0, -1):
+        pattern = generated[-n:]
+        matches = [i + n for i in range(len(source) - n + 1) if source[i:i + n] == pattern]
+        # Prefer the occurrence closest to where copying left off
+        matches = [m for m in matches if m < len(source)]
+        if matches:
+            start = min(matches, key=lambda m: abs(m - pointer))
+            return source[start:start + num_draft], start
+    return [], pointer
+
+@torch.no_grad()
+def copy_speculative_generate(model, input_ids, attention_mask, max_length, num_draft=16, max_ngram=3):
+    # Single sentence: input_ids / attention_mask of shape (1, seq_len)
+    config = model.config
+    eos_token_id = config.eos_token_id
+    encoder_outputs = model.get_encoder()(input_ids=input_ids, attention_mask=attention_mask, return_dict=True)
+
+    source = input_ids[0][attention_mask[0].bool()].tolist()
+    generated = [config.decoder_start_token_id]
+    pending = 1 # generated tokens that are not in the cache yet
+    past_key_values = None
+    pointer = 0
+    steps = 0
+
+    while len(generated) < max_length:
+        budget = max_length - len(generated) - 1
+        draft, draft_start = propose_draft(source, generated[1:], pointer, max_ngram, min(num_draft, budget))
+
+        decoder_input_ids = torch.tensor([generated[-pending:] + draft], device=input_ids.device)
+        out = model(
+            encoder_outputs=encoder_outputs,
+            attention_mask=attention_mask,
+            decoder_input_ids=decoder_input_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True)
+        steps += 1
+
+        predicted = out.logits[0, pending - 1:].argmax(-1).tolist()
+        n_accepted = 0
+        while n_accepted < len(draft) and predicted[n_accepted] == draft[n_accepted]:
+            n_accepted += 1
+        new_tokens = draft[:n_accepted] + [predicted[n_accepted]]
+
+        cache_length = len(generated) + n_accepted
+        past_key_values = _crop_cache(out.past_key_values, cache_length)
+        pointer = draft_start + n_accepted if n_accepted else pointer
+        pending = 1
+
+        if eos_token_id in new_tokens:
+            generated += new_tokens[:new_tokens.index(eos_token_id) + 1]
+            break
+        generated += new_tokens
+
+    return generated[:max_length], steps
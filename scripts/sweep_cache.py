@@ -0,0 +1,53 @@
+import gc
+import logging
+from collections import Counter
+
+import torch
+from transformers import AutoModelForSeq2SeqLM
+
+log = logging.getLogger(__name__)
+
+# Resources that do not depend on the swept hyperparameters, kept in memory across the trials of a sweep.
+# Hydra's basic launcher runs all trials in the same process, so everything here is loaded once per sweep
+class SweepCache:
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = Counter()
+        self.misses = Counter()
+        self.models = {}
+
+    def get(self, name, key, load_fn):
+        # Cached objects are shared between trials and must not be modified
+        if (name, key) in self.entries:
+            self.hits[name] += 1
+        else:
+            self.misses[name] += 1
+            self.entries[(name, key)] = load_fn()
+        return self.entries[(name, key)]
+
+    def model(self, model_name):
+        # The model of the previous trial with the pristine base weights copied back into its tensors
+        if model_name not in self.models:
+            self.misses['model'] += 1
+            model = AutoModelForSeq2SeqLM.from_pretrained(model_name)
+            pristine = {k : v.detach().clone().cpu() for k, v in model.state_dict().items()}
+            self.models[model_name] = (model, pristine)
+            return model
+
+        self.hits['model'] += 1
+        model, pristine = self.models[model_name]
+        # Optimizer state of the previous trial
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        with torch.no_grad():
+            model.load_state_dict(pristine)
+        model.zero_grad(set_to_none=True)
+        return model
+
+    def report(self, key='sweep_cache'):
+        names = sorted(set(self.hits) | set(self.misses))
+        return {f'{key}/{name}_hits' : self.hits[name] for name in names} | {f'{key}/{name}_misses' : self.misses[name] for name in names}
+
+SWEEP_CACHE = SweepCache()
@@ -0,0 +1,20 @@
+from resolution_memory import ResolutionMemory, mine_phrases
+from span_resolution import context_windows, find_ellipsis_spans
+
+RAW = 'Empfohlen wird eine Chemo- und Strahlentherapie.'
+RESOLUTION = 'Empfohlen wird eine Chemotherapie und Strahlentherapie.'
+
+def test_span_at_sentence_end_excludes_punctuation():
+    spans = find_ellipsis_spans(RAW)
+    assert [RAW[s:e] for s, e in spans] == ['Chemo- und Strahlentherapie']
+    # Windows still cover whole words
+    assert [RAW[s:e] for s, e in context_windows(RAW, spans, window=1)] == ['eine Chemo- und Strahlentherapie.']
+
+def test_mine_phrases_at_sentence_end():
+    assert mine_phrases(RAW, RESOLUTION) == [('Chemo- und Strahlentherapie', 'Chemotherapie und Strahlentherapie')]
+
+def test_memory_mined_at_sentence_end_resolves_other_positions():
+    memory = ResolutionMemory.from_pairs([RAW], [RESOLUTION])
+    assert memory.resolve('Eine Chemo- und Strahlentherapie, ggf. mit Antikörpern.') == 'Eine Chemotherapie und Strahlentherapie, ggf. mit Antikörpern.'
+    assert memory.resolve('Nach Chemo- und Strahlentherapie wurde operiert.') == 'Nach Chemotherapie und Strahlentherapie wurde operiert.'
+    assert memory.resolve(RAW) == RESOLUTION
@@ -1,5 +1,13 @@
 from transformers import Seq2SeqTrainingArguments, AutoModelForSeq2SeqLM, DataCollatorForSeq2Seq, AutoTokenizer, Seq2SeqTrainer
-from evaluation import Metrics
+from transformers import AutoModelForTokenClassification, DataCollatorForTokenClassification, Trainer
+from contextlib import contextmanager
+import numpy as np
+import torch
+from torch.utils.data import Subset
+from evaluation import Metrics, argmax_logits, compute_teacher_forced_metrics
+from edit_tagging import compute_tagging_metrics
+from distillation import distillation_loss
+from control_sampling import per_example_loss
 
 def get_tokenizer(config):
     tokenizer = AutoTokenizer.from_pretrained(config.model_name)
@@ -11,7 +19,14 @@ def get_tokenizer(config):
         tokenizer.tgt_lang = 'de'
     return tokenizer
 
-def get_training_args(config, report_to=None):
+def get_training_args(config, report_to=None, background_evaluation=False):
+    # background_evaluation: checkpoints are evaluated and pruned by a CheckpointEvaluator (checkpoint_evaluator.py)
+    distributed_config = config.get('distributed', {})
+    # Only distributed runs set the device and backend, single-process runs keep the Trainer defaults
+    distributed_kwargs = dict(
+        use_cpu=distributed_config.get('device', 'cpu') == 'cpu',
+        ddp_backend=distributed_config.get('backend'),
+    ) if distributed_config.get('num_processes', 1) > 1 else {}
     return Seq2SeqTrainingArguments(
         output_dir='./results',
         num_train_epochs=config.num_epochs,
@@ -20,32 +35,191 @@ def get_training_args(config, report_to=None):
         logging_dir='./logs',
         logging_steps=100,
         warmup_steps=config.warmup_steps,
-        load_best_model_at_end=True,
-        predict_with_generate=True,
+        load_best_model_at_end=not background_evaluation,
+        predict_with_generate=config.get('validation', {}).get('mode', 'generate') == 'generate',
         learning_rate=config.learning_rate,
         weight_decay=config.weight_decay,
         generation_max_length=config.generation_max_length,
-        evaluation_strategy="epoch",
+        eval_strategy="no" if background_evaluation else "epoch",
         save_strategy="epoch", # epoch
         report_to=report_to,
         fp16=config.fp16,
         metric_for_best_model="exact_match",
-        save_total_limit=1,
+        save_total_limit=None if background_evaluation else 1,
+        **distributed_kwargs
     )
 
-def get_trainer(config, tokenizer, training_args, train_data, val_data):
-    model = AutoModelForSeq2SeqLM.from_pretrained(config.model_name)
+# Without predict_with_generate, the per-epoch validation is teacher-forced (one forward pass) and a fixed subset
+# of the dev set can additionally be generated, reported with the prefix eval_gen.
+# With a control_sampler (control_sampling.py), the training data is an IndexedDataset and the per-example training
+# losses are passed to the sampler, which selects the control sentences of every epoch
+class EllipsesSeq2SeqTrainer(Seq2SeqTrainer):
 
+    def __init__(self, *args, generation_dataset=None, generation_metrics=None, control_sampler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.generation_dataset = generation_dataset
+        self.generation_metrics = generation_metrics
+        self.control_sampler = control_sampler
+
+    def _get_train_sampler(self, *args, **kwargs):
+        # Newer versions pass the train dataset
+        if self.control_sampler is not None:
+            return self.control_sampler
+        return super()._get_train_sampler(*args, **kwargs)
+
+    def create_scheduler(self, num_training_steps, optimizer=None):
+        # The number of training steps is computed from the first, full epoch. With the smaller sampled epochs, a
+        # step-based linear decay would stop early, it follows the epoch progress instead
+        if self.control_sampler is None or self.lr_scheduler is not None or self.args.lr_scheduler_type != 'linear':
+            return super().create_scheduler(num_training_steps, optimizer)
+        warmup_steps = self.args.get_warmup_steps(num_training_steps)
+        warmup_progress = warmup_steps / max(1, num_training_steps)
+
+        def lr_lambda(step):
+            if step < warmup_steps:
+                return step / max(1, warmup_steps)
+            progress = (self.state.epoch or 0) / self.args.num_train_epochs
+            return min(1.0, max(0.0, (1 - progress) / (1 - warmup_progress)))
+
+        self.lr_scheduler = torch.optim.lr_scheduler.LambdaLR(self.optimizer if optimizer is None else optimizer, lr_lambda)
+        self._created_lr_scheduler = True
+        return self.lr_scheduler
+
+    def _set_signature_columns_if_needed(self):
+        # Otherwise removed from the batches as it is not an argument of the model
+        super()._set_signature_columns_if_needed()
+        if self.control_sampler is not None and 'example_index' not in self._signature_columns:
+            self._signature_columns.append('example_index')
+
+    def compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
+        example_index = inputs.pop('example_index', None)
+        kwargs = {'num_items_in_batch' : num_items_in_batch} if num_items_in_batch is not None else {}
+        if example_index is None or self.control_sampler is None:
+            return super().compute_loss(model, inputs, return_outputs=return_outputs, **kwargs)
+        loss, outputs = super().compute_loss(model, inputs, return_outputs=True, **kwargs)
+        if model.training:
+            self.control_sampler.update(example_index.cpu().numpy(), per_example_loss(outputs.logits.detach(), inputs['labels']).cpu().numpy())
+        return (loss, outputs) if return_outputs else loss
+
+    @contextmanager
+    def _generating(self):
+        saved = self.args.predict_with_generate, self.compute_metrics, self.preprocess_logits_for_metrics
+        self.args.predict_with_generate = True
+        self.compute_metrics, self.preprocess_logits_for_metrics = self.generation_metrics, None
+        try:
+            yield
+        finally:
+            self.args.predict_with_generate, self.compute_metrics, self.preprocess_logits_for_metrics = saved
+
+    def evaluate(self, eval_dataset=None, ignore_keys=None, metric_key_prefix='eval', **gen_kwargs):
+        metrics = super().evaluate(eval_dataset, ignore_keys=ignore_keys, metric_key_prefix=metric_key_prefix, **gen_kwargs)
+        if self.args.predict_with_generate or self.generation_dataset is None or eval_dataset is not None:
+            return metrics
+        with self._generating():
+            metrics.update(super().evaluate(self.generation_dataset, ignore_keys=ignore_keys, metric_key_prefix=metric_key_prefix + '_gen', **gen_kwargs))
+        return metrics
+
+def get_generation_subset(val_data, size, seed):
+    if not size or size >= len(val_data):
+        return val_data
+    return Subset(val_data, np.random.default_rng(seed).choice(len(val_data), size, replace=False).tolist())
+
+def _metric_kwargs(config, tokenizer, training_args, val_data):
     metrics = Metrics(config.metrics, tokenizer)
+    if training_args.predict_with_generate:
+        return dict(compute_metrics=metrics.compute_metrics)
+    generation_subset = config.get('validation', {}).get('generation_subset', 0)
+    return dict(
+        compute_metrics=compute_teacher_forced_metrics,
+        preprocess_logits_for_metrics=argmax_logits,
+        generation_dataset=get_generation_subset(val_data, generation_subset, config.random_seed) if generation_subset else None,
+        generation_metrics=metrics.compute_metrics)
+
+def get_trainer(config, tokenizer, training_args, train_data, val_data, callbacks=None, model=None, control_sampler=None):
+    if model is None:
+        model = AutoModelForSeq2SeqLM.from_pretrained(config.model_name)
+
     data_collator = DataCollatorForSeq2Seq(tokenizer=tokenizer, model=model)
 
-    return Seq2SeqTrainer(
+    return EllipsesSeq2SeqTrainer(
         model=model,
         args=training_args,
         train_dataset=train_data,
         eval_dataset=val_data,
         data_collator=data_collator,
-        compute_metrics=metrics.compute_metrics
+        callbacks=callbacks,
+        control_sampler=control_sampler,
+        **_metric_kwargs(config, tokenizer, training_args, val_data)
     )
-    
 
+# Student training on the targets of the dataset (gold or teacher outputs) and the soft targets of the teacher:
+# alpha * cross-entropy + (1 - alpha) * distillation_loss
+class DistillationTrainer(EllipsesSeq2SeqTrainer):
+
+    def __init__(self, *args, teacher=None, alpha=0.5, temperature=2.0, vocab_mapping=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.teacher = teacher.to(self.args.device).eval()
+        self.alpha = alpha
+        self.temperature = temperature
+        # Student with a trimmed vocabulary (trim_vocab.py): teacher ids of the student ids
+        self.vocab_mapping = torch.tensor(vocab_mapping, device=self.args.device) if vocab_mapping is not None else None
+
+    def _teacher_logits(self, inputs):
+        if self.vocab_mapping is None:
+            return self.teacher(**inputs).logits
+        # Token ids of the student vocabulary, labels are padded with -100
+        teacher_inputs = {
+            k : torch.where(v >= 0, self.vocab_mapping[v.clamp(min=0)], v) if k in ('input_ids', 'decoder_input_ids', 'labels') else v
+            for k, v in inputs.items()
+        }
+        return self.teacher(**teacher_inputs).logits[..., self.vocab_mapping]
+
+    def compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
+        outputs = model(**inputs)
+        loss = outputs.loss
+        if self.alpha < 1:
+            with torch.no_grad():
+                teacher_logits = self._teacher_logits(inputs)
+            loss = self.alpha * loss + (1 - self.alpha) * distillation_loss(outputs.logits, teacher_logits, inputs['labels'], self.temperature)
+        return (loss, outputs) if return_outputs else loss
+
+def get_distillation_trainer(config, tokenizer, training_args, teacher, train_data, val_data, callbacks=None, vocab_mapping=None):
+    distillation_config = config.distillation
+    student = AutoModelForSeq2SeqLM.from_pretrained(distillation_config.student_model_name)
+
+    data_collator = DataCollatorForSeq2Seq(tokenizer=tokenizer, model=student)
+
+    return DistillationTrainer(
+        model=student,
+        args=training_args,
+        train_dataset=train_data,
+        eval_dataset=val_data,
+        data_collator=data_collator,
+        callbacks=callbacks,
+        teacher=teacher,
+        alpha=distillation_config.get('alpha', 0.5),
+        temperature=distillation_config.get('temperature', 2.0),
+        vocab_mapping=vocab_mapping,
+        **_metric_kwargs(config, tokenizer, training_args, val_data)
+    )
+
+def get_tagger_tokenizer(config):
+    return AutoTokenizer.from_pretrained(config.tagger.model_name)
+
+def get_tagger_trainer(config, tokenizer, training_args, train_data, val_data, vocab):
+    model = AutoModelForTokenClassification.from_pretrained(
+        config.tagger.model_name,
+        num_labels=len(vocab),
+        id2label=dict(enumerate(vocab.tags)),
+        label2id=vocab.tag2id)
+
+    data_collator = DataCollatorForTokenClassification(tokenizer=tokenizer)
+
+    return Trainer(
+        model=model,
+        args=training_args,
+        train_dataset=train_data,
+        eval_dataset=val_data,
+        data_collator=data_collator,
+        compute_metrics=compute_tagging_metrics
+    )
@@ -0,0 +1,152 @@
+import hydra
+from omegaconf import DictConfig, OmegaConf
+from hydra.utils import to_absolute_path
+
+import json
+import logging
+import re
+from collections import Counter
+from pathlib import Path
+
+import torch
+from sentencepiece import sentencepiece_model_pb2
+from transformers import AutoModelForSeq2SeqLM, AutoTokenizer, T5Tokenizer
+
+from dataset import load_data, read_corpus_sentences
+from inference import BatchedGenerator
+from transformers_util import get_tokenizer
+
+log = logging.getLogger(__name__)
+
+# Ids of the original vocabulary in the order of the trimmed vocabulary, written next to the trimmed model
+VOCAB_MAPPING = 'vocab_mapping.json'
+EXTRA_ID_RE = re.compile(r'<extra_id_\d+>')
+
+def count_token_ids(tokenizer, sentences, batch_size=1000):
+    counts = Counter()
+    sentences = list(sentences)
+    for i in range(0, len(sentences), batch_size):
+        for ids in tokenizer(sentences[i:i + batch_size])['input_ids']:
+            counts.update(ids)
+    return counts
+
+def select_pieces(proto, counts, characters, min_count=1):
+    # Indices of the sentencepiece pieces to keep: control/unknown/byte pieces, pieces seen at least min_count times
+    # and single-character pieces of every seen character, so that text with unseen words can still be segmented
+    keep = []
+    for i, piece in enumerate(proto.pieces):
+        if piece.type != sentencepiece_model_pb2.ModelProto.SentencePiece.NORMAL:
+            keep.append(i)
+        elif counts[i] >= min_count or len(piece.piece.lstrip('▁')) <= 1 and piece.piece.lstrip('▁') in characters:
+            keep.append(i)
+    return keep
+
+def trim_tokenizer(tokenizer, counts, characters, path, min_count=1):
+    # With a unigram model, removing pieces only removes segmentation candidates: text whose original segmentation
+    # uses kept pieces only is segmented identically by the trimmed tokenizer
+    if 'T5' not in type(tokenizer).__name__ or not getattr(tokenizer, 'vocab_file', None):
+        raise ValueError(f'Vocabulary trimming needs a sentencepiece T5/mT5 tokenizer, got {type(tokenizer).__name__}')
+    proto = sentencepiece_model_pb2.ModelProto()
+    with open(tokenizer.vocab_file, 'rb') as f:
+        proto.ParseFromString(f.read())
+
+    keep = select_pieces(proto, counts, characters, min_count)
+    pieces = [proto.pieces[i] for i in keep]
+    del proto.pieces[:]
+    proto.pieces.extend(pieces)
+
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    with open(path / 'spiece.model', 'wb') as f:
+        f.write(proto.SerializeToString())
+
+    old_vocab = tokenizer.get_vocab()
+    extra_ids = sum(1 for token in old_vocab if EXTRA_ID_RE.fullmatch(token))
+    T5Tokenizer(str(path / 'spiece.model'), extra_ids=extra_ids, legacy=getattr(tokenizer, 'legacy', True)).save_pretrained(path)
+    trimmed = AutoTokenizer.from_pretrained(path)
+
+    new_vocab = trimmed.get_vocab()
+    if sorted(new_vocab.values()) != list(range(len(new_vocab))):
+        raise ValueError('Trimmed vocabulary ids are not contiguous')
+    mapping = [old_vocab[token] for token in sorted(new_vocab, key=new_vocab.get)]
+    return trimmed, mapping
+
+def trim_model(model, mapping):
+    # Keeps the embedding and LM head rows of the mapped ids, logits of kept tokens are unchanged
+    index = torch.tensor(mapping, dtype=torch.long)
+    embeddings = model.get_input_embeddings()
+    new_embeddings = torch.nn.Embedding(len(mapping), embeddings.embedding_dim)
+    new_embeddings.weight.data = embeddings.weight.data[index].clone()
+    model.set_input_embeddings(new_embeddings)
+
+    if not model.config.tie_word_embeddings:
+        lm_head = model.get_output_embeddings()
+        new_lm_head = torch.nn.Linear(lm_head.in_features, len(mapping), bias=False)
+        new_lm_head.weight.data = lm_head.weight.data[index].clone()
+        model.set_output_embeddings(new_lm_head)
+    model.config.vocab_size = len(mapping)
+    model.tie_weights()
+    return model
+
+def in_vocabulary(tokenizer, trimmed, mapping, sentences):
+    # Sentences that are tokenized identically (after mapping the ids) by both tokenizers
+    old = tokenizer(list(sentences))['input_ids']
+    new = trimmed(list(sentences))['input_ids']
+    return [o == [mapping[i] for i in n] for o, n in zip(old, new)]
+
+def load_vocab_mapping(path):
+    # None for models with the original vocabulary
+    mapping_file = Path(path) / VOCAB_MAPPING
+    if not mapping_file.exists():
+        return None
+    with open(mapping_file) as f:
+        return json.load(f)
+
+@hydra.main(config_path='..', config_name='experiment.yaml', version_base="1.2")
+def main(config: DictConfig):
+    trim_config = config.vocab_trimming
+    log.info(OmegaConf.to_yaml(trim_config))
+    checkpoint = to_absolute_path(trim_config.checkpoint) if trim_config.get('checkpoint') else config.model_name
+    tokenizer = get_tokenizer(config)
+
+    train_df, val_df, test_df = load_data(
+        to_absolute_path(config.data.cnf_tsv_path),
+        to_absolute_path(config.data.controls_tsv_path) if config.data.controls_tsv_path else None)
+    sentences = [s for df in [train_df, val_df, test_df] for col in ['raw_sentence', 'full_resolution'] for s in df[col]]
+    if trim_config.get('corpus_path'):
+        sentences += [s for _, _, s in read_corpus_sentences(to_absolute_path(trim_config.corpus_path), tokens=trim_config.get('corpus_tokens', False))]
+    log.info(f'Counting tokens in {len(sentences)} sentences')
+    counts = count_token_ids(tokenizer, sentences)
+    characters = set(''.join(sentences))
+
+    output_path = Path(to_absolute_path(trim_config.output_path))
+    trimmed_tokenizer, mapping = trim_tokenizer(tokenizer, counts, characters, output_path, trim_config.get('min_count', 1))
+
+    model = AutoModelForSeq2SeqLM.from_pretrained(checkpoint)
+    n_params = model.num_parameters()
+    trim_model(model, mapping)
+    model.save_pretrained(output_path)
+    with open(output_path / VOCAB_MAPPING, 'w') as f:
+        json.dump(mapping, f)
+
+    report = {
+        'vocab_size' : len(tokenizer),
+        'trimmed_vocab_size' : len(mapping),
+        'parameters' : n_params,
+        'trimmed_parameters' : model.num_parameters(),
+        'in_vocabulary_dev' : sum(in_vocabulary(tokenizer, trimmed_tokenizer, mapping, val_df.raw_sentence)) / len(val_df),
+    }
+
+    if trim_config.get('n_check'):
+        # Greedy outputs of both models on in-vocabulary dev sentences
+        sample = val_df.raw_sentence[in_vocabulary(tokenizer, trimmed_tokenizer, mapping, val_df.raw_sentence)].iloc[:trim_config.n_check]
+        full = BatchedGenerator.from_config(AutoModelForSeq2SeqLM.from_pretrained(checkpoint), tokenizer, config)(sample)
+        trimmed = BatchedGenerator.from_config(model, trimmed_tokenizer, config)(sample)
+        report['identical_outputs'] = sum(a == b for a, b in zip(full, trimmed)) / len(sample) if len(sample) else None
+
+    log.info(report)
+    with open(output_path / 'trimming_report.json', 'w') as f:
+        json.dump(report, f, indent=1)
+
+if __name__ == "__main__":
+    main()